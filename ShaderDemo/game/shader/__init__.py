@@ -1,12 +1,20 @@
 
+import os
 import renpy
 
 import utils
-from controller import RenderController, RenderContext, ControllerContextStore
-from rendering import Renderer2D, Renderer3D, SkinnedRenderer
+import gpu
+import profiler
+from controller import RenderController, RenderContext, ControllerContextStore, FrameScheduler, FrameCache, createFrameKey, blitFrame
+from rendering import Renderer2D, Renderer3D, SkinnedRenderer, InstancedSkinnedRenderer
 from rigeditor import RigEditor
 from skinnedplayer import TrackInfo, AnimationPlayer
 from shadercode import *
+import controller
+import rendering
+import skin
+import skinnedmesh
+import quality
 
 PROJECTION = "projection"
 
@@ -20,13 +28,45 @@ TEX1 = "tex1"
 MODE_2D = "2d"
 MODE_3D = "3d"
 MODE_SKINNED = "skinned"
+MODE_SKINNED_INSTANCED = "skinnedinstanced"
 
 ZERO_INFLUENCE = "zeroinfluence.png"
 
 class config:
     enabled = True
     fps = 60
+    profile = False #Collect per-phase timings, see getProfiler()
+    profileOverlay = False #Draw the timings on top of every shader displayable
+    frameBudget = None #Seconds of render and readback time per frame shared by all displayables, None is unlimited
+    minFps = 10 #Lowest rate the frame budget can drop a displayable to
     flipMeshX = True
+    useBufferObjects = True #Keep static mesh data in GPU buffers instead of client arrays
+    asyncReadback = False #Read rendered frames back through pixel buffers, adds one frame of latency
+    asyncReadbackBuffers = 2
+    textureOutput = False #Pass rendered textures directly to Ren'Py without a CPU readback
+    surfacePoolSize = 4 #Maximum number of reusable readback surfaces per displayable
+    frameBufferPoolSize = 2 #Unused render targets kept per size
+    renderScale = 1.0 #Render resolution relative to the image size, "auto" adjusts it. Can be overridden with the "renderScale" arg
+    renderScaleTarget = 1.0 / 120 #Seconds per frame that "auto" aims for
+    renderScaleMin = 0.5
+    multiPassBlur = True #Draw PS_BLUR_2D in separable passes, at a reduced resolution for large blurs. Can be overridden with the "multiPassBlur" arg
+    blurMinScale = 0.125 #Smallest resolution the multi-pass blur goes down to
+    tiledLights = True #Bin PS_DEFERRED lights into screen tiles, lifts the light limit. Can be overridden with the "tiledLights" arg
+    deferredTileSize = 32 #Pixels
+    depthPyramid = True #Trace PS_DEFERRED shadows through a min-depth pyramid, needs NumPy. Can be overridden with the "depthPyramid" arg
+    deferredQuality = "high" #PS_DEFERRED quality tier, see quality.TIERS. "auto" picks one from the measured frame time. Can be overridden with the "quality" arg
+    deferredQualityBudget = 1.0 / 120 #Seconds of render and readback time per frame that "auto" aims for
+    deferredQualityWarmup = 30 #Frames measured for every tier
+    programBinaryCache = False #Store linked shader programs under the save directory
+    textureCacheBudget = 128 * 1024 * 1024 #Bytes of unreferenced textures to keep around
+    frameCacheBudget = 64 * 1024 * 1024 #Bytes of rendered frames kept for displayables with the "cacheFrames" arg
+    rigAtlas = False #Pack rig images into shared atlas pages, can be overridden with the "atlas" arg
+    rigAtlasPageSize = (2048, 2048)
+    rigAtlasDiskCache = False #Save atlas pages next to the .rig file
+    changeDetection = False #Skip rendering when inputs have not changed, can be overridden with the "changeDetection" arg
+    effectFps = None #Rate for time dependent shaders with change detection, None is fps. Can be overridden with the "effectFps" arg
+    batchSkinnedMeshes = True #Merge visible bone meshes into one stream, can be overridden with the "batch" arg
+    boneTexture = True #Send bone data in a float texture when supported, lifts the bone limit. Can be overridden with the "boneTexture" arg
 
 def log(message):
     renpy.display.log.write("Shaders: " + message)
@@ -54,6 +94,145 @@ def isSupported(verbose=False):
     return True
 
 _controllerContextStore = ControllerContextStore()
+_programCache = gpu.ProgramCache()
+_programBinaryCache = None
+
+def getProgramBinaryCache():
+    global _programBinaryCache
+    if not config.programBinaryCache or not gpu.isProgramBinarySupported():
+        return None
+
+    if not _programBinaryCache:
+        _programBinaryCache = gpu.ProgramBinaryCache(os.path.join(renpy.config.savedir, "shadercache"))
+    return _programBinaryCache
+
+def acquireProgram(vertexShader, pixelShader, defines=None):
+    return _programCache.acquire(vertexShader, pixelShader, getModeChangeCount(), defines, getProgramBinaryCache())
+
+def releaseProgram(program):
+    _programCache.release(program)
+
+_textureCache = gpu.TextureCache(config.textureCacheBudget)
+
+def getImageKey(image):
+    #Returns a key that identifies the image data or None if it can't be shared
+    if isinstance(image, basestring):
+        return image
+    name = getattr(image, "name", None)
+    if isinstance(name, tuple):
+        return " ".join(name)
+    filename = getattr(image, "filename", None)
+    if isinstance(filename, basestring):
+        return filename
+    return None
+
+def acquireTexture(key, loader):
+    _textureCache.budget = config.textureCacheBudget
+    return _textureCache.acquire(key, loader, getModeChangeCount())
+
+def releaseTexture(texture):
+    _textureCache.release(texture)
+
+def getTextureCacheStats():
+    return _textureCache.getStats()
+
+def getTextureCacheEntries():
+    return _textureCache.getEntries()
+
+_frameBufferPool = gpu.FrameBufferPool(config.frameBufferPoolSize)
+
+def acquireFrameBuffer(width, height, depth):
+    _frameBufferPool.maxFree = config.frameBufferPoolSize
+    return _frameBufferPool.acquire(width, height, depth, getModeChangeCount())
+
+def releaseFrameBuffer(frameBuffer):
+    _frameBufferPool.release(frameBuffer, getModeChangeCount())
+
+def trimFrameBuffers():
+    _frameBufferPool.trim()
+
+def getFrameBufferPoolStats():
+    return _frameBufferPool.getStats()
+
+_profiler = profiler.Profiler()
+
+def profile(name, gpu=False):
+    #Scoped timer, use with the 'with' statement. Does nothing unless config.profile is set.
+    if not config.profile:
+        return profiler.NULL_SCOPE
+    return _profiler.scope(name, gpu)
+
+def getProfiler():
+    return _profiler
+
+def exportProfile(path):
+    _profiler.exportCsv(path)
+
+_frameCache = FrameCache(config.frameCacheBudget)
+
+def getCachedFrame(key):
+    return _frameCache.get(key)
+
+def cacheFrame(key, surface):
+    _frameCache.budget = config.frameCacheBudget
+    _frameCache.add(key, surface)
+
+def getFrameCacheStats():
+    return _frameCache.getStats()
+
+def getFrameRates():
+    return _controllerContextStore.getFrameRates()
+
+_glRecorder = None
+
+def _getRecordedModules():
+    #Not the profiler, its query polling depends on timing
+    return [gpu.buffers, gpu.framebuffer, gpu.pixelbuffer, gpu.programbinary, gpu.shaderprogram,
+        gpu.texture, gpu.glstate, gpu.datatexture, controller, rendering, skin, skinnedmesh, quality, utils]
+
+def startGLRecording():
+    #Counts every OpenGL call the shader modules make, call endGLFrame() after each frame
+    global _glRecorder
+    if not _glRecorder:
+        _glRecorder = gpu.GLRecorder()
+        _glRecorder.install(_getRecordedModules())
+    _glRecorder.reset()
+    return _glRecorder
+
+def stopGLRecording():
+    global _glRecorder
+    recorder = _glRecorder
+    if recorder:
+        recorder.uninstall()
+        _glRecorder = None
+    return recorder
+
+def endGLFrame():
+    if _glRecorder:
+        _glRecorder.endFrame()
+
+def getDeferredLightLimit(renderer=None):
+    #How many lights PS_DEFERRED can use at once, give the renderer
+    #to take its "tiledLights" arg into account
+    limit = getattr(renderer, "lightLimit", None)
+    if limit:
+        return limit
+    if rendering.isTiledLightingEnabled():
+        return DEFERRED_MAX_TILED_LIGHTS
+    return DEFERRED_MAX_LIGHTS
+
+def resetDeferredQuality():
+    #Forgets the tiers "auto" has picked, new displayables measure again
+    quality.clearSavedTiers()
+
+def getGLStateStats():
+    return gpu.getState().getStats()
+
+def getProgramCacheStats():
+    stats = _programCache.getStats()
+    if _programBinaryCache:
+        stats["binary"] = _programBinaryCache.getStats()
+    return stats
 
 _coreSetMode = None
 _coreSetModeCounter = 0
@@ -61,6 +240,7 @@ _coreSetModeCounter = 0
 def _wrapSetMode(*args):
     global _coreSetModeCounter
     _coreSetModeCounter += 1
+    _profiler.resetQueries()
 
     _coreSetMode(*args)
 
@@ -0,0 +1,188 @@
+
+import os
+import json
+import renpy
+import pygame_sdl2 as pygame
+
+VERSION = 2
+
+def getImageStamp(name):
+    #Modification times of the files behind an image name. Files inside
+    #an archive have none, those only change with a new build anyway.
+    image = renpy.exports.displayable(name)
+    if isinstance(image, renpy.display.image.ImageReference):
+        image = renpy.display.image.images.get(tuple(name.split()), image)
+    if not isinstance(image, renpy.display.im.ImageBase):
+        return []
+
+    stamps = []
+    for fileName in image.predict_files():
+        try:
+            stamps.append([fileName, os.path.getmtime(renpy.loader.transfn(fileName))])
+        except Exception:
+            stamps.append([fileName, None])
+    return stamps
+
+class AtlasRegion:
+    def __init__(self, name, page, x, y, width, height):
+        self.name = name
+        self.page = page
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+class ShelfPacker:
+    #Simple shelf packer. Items are sorted by height and placed left to right
+    #on horizontal shelves, starting a new page when a page runs out of space.
+
+    def __init__(self, pageWidth, pageHeight, padding):
+        self.pageWidth = pageWidth
+        self.pageHeight = pageHeight
+        self.padding = padding
+
+    def pack(self, items):
+        #Items are (name, width, height), returns a list of AtlasRegions
+        items = sorted(items, key=lambda item: (-item[2], -item[1], item[0]))
+        pad = self.padding
+
+        regions = []
+        page = 0
+        x = pad
+        y = pad
+        shelfHeight = 0
+
+        for name, width, height in items:
+            if width + pad * 2 > self.pageWidth or height + pad * 2 > self.pageHeight:
+                raise RuntimeError("Image %s (%ix%i) does not fit in an atlas page" % (name, width, height))
+
+            if x + width + pad > self.pageWidth:
+                #Start a new shelf
+                x = pad
+                y += shelfHeight + pad
+                shelfHeight = 0
+
+            if y + height + pad > self.pageHeight:
+                #Start a new page
+                page += 1
+                x = pad
+                y = pad
+                shelfHeight = 0
+
+            regions.append(AtlasRegion(name, page, x, y, width, height))
+            x += width + pad
+            shelfHeight = max(shelfHeight, height)
+
+        return regions
+
+class RigAtlas:
+    #Packs all bone images of a rig into shared texture pages. The layout is
+    #computed from the rig data alone, images are only loaded when a page
+    #is actually needed. Influence images use the same layout in separate pages.
+
+    def __init__(self, rigPath, bones, pageSize, padding=2, sources=None):
+        self.rigPath = rigPath
+        self.pageSize = pageSize
+        self.sources = sources #Returns the image names a bone is loaded from
+        self.images = {}
+        for bone in bones.values():
+            if bone.image:
+                self.images[bone.image.name] = bone
+
+        items = [(name, bone.image.width, bone.image.height) for name, bone in self.images.items()]
+        packer = ShelfPacker(pageSize[0], pageSize[1], padding)
+
+        self.regions = {}
+        self.pageCount = 0
+        for region in packer.pack(items):
+            self.regions[region.name] = region
+            self.pageCount = max(self.pageCount, region.page + 1)
+
+    def getRegion(self, name):
+        return self.regions[name]
+
+    def getUvRect(self, name):
+        region = self.regions[name]
+        w = float(self.pageSize[0])
+        h = float(self.pageSize[1])
+        return (region.x / w, region.y / h, region.width / w, region.height / h)
+
+    def getSignature(self):
+        regions = []
+        for name in sorted(self.regions):
+            region = self.regions[name]
+            image = self.images[name].image
+            regions.append([name, region.page, region.x, region.y, region.width, region.height,
+                image.x, image.y, image.originalWidth, image.originalHeight, self.getStamps(name)])
+        return {"version": VERSION, "pageSize": list(self.pageSize), "regions": regions}
+
+    def getStamps(self, name):
+        #Edited images must not be served from the disk cache
+        names = self.sources(self.images[name]) if self.sources else [name]
+        return [getImageStamp(source) for source in names]
+
+    def createPage(self, index, loader, influence):
+        #Loader returns a cropped surface for a bone or None if there is none
+        page = None
+        for name, region in sorted(self.regions.items()):
+            if region.page != index:
+                continue
+
+            surface = loader(self.images[name], influence)
+            if surface is None:
+                continue
+
+            if page is None:
+                page = pygame.Surface(self.pageSize, 0, surface)
+                page.fill((0, 0, 0, 0))
+
+            if surface.get_size() != (region.width, region.height):
+                surface = pygame.transform.smoothscale(surface, (region.width, region.height))
+            page.blit(surface, (region.x, region.y))
+        return page
+
+    #Disk cache
+
+    def getCachePath(self, postfix):
+        path = self.rigPath
+        if not os.path.isabs(path):
+            path = os.path.join(renpy.config.gamedir, path)
+        return path + postfix
+
+    def getPagePath(self, index, influence):
+        return self.getCachePath(".atlas%s%i.png" % ("influence" if influence else "", index))
+
+    def loadCachedPage(self, index, influence):
+        try:
+            with open(self.getCachePath(".atlas.json")) as f:
+                if json.load(f) != self.getSignature():
+                    return None
+
+            path = self.getPagePath(index, influence)
+            with open(path, "rb") as f:
+                return renpy.display.pgrender.load_image(f, path)
+        except (IOError, ValueError, pygame.error):
+            return None
+
+    def saveCachedPage(self, index, influence, surface):
+        try:
+            pygame.image.save(surface, self.getPagePath(index, influence))
+            with open(self.getCachePath(".atlas.json"), "w") as f:
+                json.dump(self.getSignature(), f, indent=1, sort_keys=True)
+        except (IOError, OSError, pygame.error):
+            #Read-only game directory etc., just skip caching
+            pass
+
+    def loadPage(self, index, influence, loader, useCache):
+        if useCache:
+            page = self.loadCachedPage(index, influence)
+            if page:
+                return page
+
+        page = self.createPage(index, loader, influence)
+        if page is None:
+            return None
+
+        if useCache:
+            self.saveCachedPage(index, influence, page)
+        return page
@@ -0,0 +1,83 @@
+
+import gpu
+
+#Bone data for the skinning vertex shaders. Shaders with BONE_DATA_CODE get a
+#readBone() function that hides where the data comes from:
+#
+#   void readBone(int index, out vec2 axisX, out vec2 axisY, out vec2 offset, out vec4 params)
+#
+#The 2D affine transform is point.x * axisX + point.y * axisY + offset and
+#params has the damping delta (xy), dampness and transparency.
+
+BONE_DATA_CODE = "BONE_DATA_CODE"
+
+TEXTURE_COLUMNS = 3
+TEXTURE_UNIT = 2 #Units 0 and 1 are the bone image and its influence
+
+UNIFORM_CODE = """
+UNIFORM mat4 boneMatrices[MAX_BONES];
+
+void readBone(int index, out vec2 axisX, out vec2 axisY, out vec2 offset, out vec4 params)
+{
+    mat4 boneMatrix = boneMatrices[index];
+    axisX = boneMatrix[0].xy;
+    axisY = boneMatrix[1].xy;
+    offset = boneMatrix[3].xy;
+    params = vec4(boneMatrix[0][3], boneMatrix[1][3], boneMatrix[2][3], boneMatrix[3][3]);
+}
+"""
+
+TEXTURE_CODE = """
+UNIFORM sampler2D boneData;
+UNIFORM float boneDataRows;
+
+vec4 readBoneTexel(int index, float column)
+{
+    return texture2DLod(boneData, vec2((column + 0.5) / %(columns).1f, (float(index) + 0.5) / boneDataRows), 0.0);
+}
+
+void readBone(int index, out vec2 axisX, out vec2 axisY, out vec2 offset, out vec4 params)
+{
+    vec4 axes = readBoneTexel(index, 0.0);
+    vec4 offsetAndParams = readBoneTexel(index, 1.0);
+    vec4 delta = readBoneTexel(index, 2.0);
+    axisX = axes.xy;
+    axisY = axes.zw;
+    offset = offsetAndParams.xy;
+    params = vec4(delta.xy, offsetAndParams.zw);
+}
+""" % {"columns": TEXTURE_COLUMNS}
+
+def hasBoneDataCode(vertexShader):
+    return BONE_DATA_CODE in vertexShader
+
+def createShaderCode(vertexShader, useTexture):
+    return vertexShader.replace(BONE_DATA_CODE, TEXTURE_CODE if useTexture else UNIFORM_CODE)
+
+def packTextureRow(values, offset):
+    #One bone from the column major matrix list, see utils.matrixToList()
+    v = values
+    i = offset
+    return (v[i], v[i + 1], v[i + 4], v[i + 5],
+        v[i + 12], v[i + 13], v[i + 11], v[i + 15],
+        v[i + 3], v[i + 7], 0.0, 0.0)
+
+class BoneTexture:
+    #Sends the 3x2 transforms and bone parameters in a float texture, three
+    #texels per bone, so the bone count is not limited by the uniforms.
+
+    def __init__(self):
+        self.texture = gpu.DataTexture(TEXTURE_COLUMNS, TEXTURE_UNIT)
+
+    def free(self):
+        self.texture.free()
+
+    def upload(self, program, boneMatrixArray):
+        rows = [packTextureRow(boneMatrixArray, i) for i in range(0, len(boneMatrixArray), 16)]
+        self.texture.update(rows)
+        self.texture.bind()
+        program.uniformi("boneData", TEXTURE_UNIT)
+        program.uniformf("boneDataRows", float(self.texture.rows))
+
+    def getStats(self):
+        return self.texture.getStats()
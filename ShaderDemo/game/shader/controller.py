@@ -1,12 +1,16 @@
 
 import renpy
+import copy
+import collections
 from OpenGL import GL as gl
 
 import shader
 import gpu
+import euclid
+import utils
 
 class RenderContext(object):
-    def __init__(self, renderer, w, h, time, shownTime, animationTime, uniforms, mousePos, events, store, overlayRender):
+    def __init__(self, renderer, w, h, time, shownTime, animationTime, uniforms, mousePos, events, store):
         self.renderer = renderer
         self.width = w
         self.height = h
@@ -18,19 +22,259 @@ class RenderContext(object):
         self.events = events
         self.store = store
         self.continueRendering = True
-        self.overlayRender = overlayRender
+        self.overlayRender = None
         self.overlayCanvas = None
+        self.frameBuffer = None #Target of the current render, renderers with several passes bind it again
+        self.parent = None
+
+    def withRenderer(self, renderer):
+        #Same frame for something else with getBones(), like an instance of an instanced rig
+        context = copy.copy(self)
+        context.renderer = renderer
+        context.parent = self.parent or self
+        return context
 
     def createOverlayCanvas(self):
+        if self.parent:
+            #Only the original context is drawn
+            self.parent.createOverlayCanvas()
+            self.overlayRender = self.parent.overlayRender
+            self.overlayCanvas = self.parent.overlayCanvas
+            return
+
         if self.overlayCanvas is not None:
             return
+        self.overlayRender = renpy.display.render.Render(self.width, self.height)
         self.overlayCanvas = self.overlayRender.canvas()
         self.overlayCanvas.rect("#f00", (0, 0, self.width - 1, self.height - 1), 1)
 
 
+class SurfacePool:
+    #Keeps a small ring of surfaces per size so rendered frames can be
+    #copied out without allocating a new surface every time.
+
+    def __init__(self, maxSurfaces=4, ringSize=2):
+        self.maxSurfaces = maxSurfaces
+        self.ringSize = ringSize
+        self.entries = {}
+        self.positions = {}
+        self.lastUsed = {}
+        self.useCounter = 0
+        self.allocated = 0
+        self.reused = 0
+        self.peak = 0
+
+    def getSurfaceCount(self):
+        return sum([len(surfaces) for surfaces in self.entries.values()])
+
+    def get(self, width, height):
+        key = (width, height)
+        self.useCounter += 1
+        self.lastUsed[key] = self.useCounter
+
+        surfaces = self.entries.get(key)
+        if surfaces is None:
+            surfaces = []
+            self.entries[key] = surfaces
+
+        if len(surfaces) < self.ringSize:
+            self.trim(self.maxSurfaces - 1, key)
+            surface = renpy.display.pgrender.surface((width, height), True)
+            surfaces.append(surface)
+            self.allocated += 1
+            self.peak = max(self.peak, self.getSurfaceCount())
+            return surface
+
+        position = (self.positions.get(key, 0) + 1) % len(surfaces)
+        self.positions[key] = position
+        self.reused += 1
+        return surfaces[position]
+
+    def trim(self, maxSurfaces, keep=None):
+        #Drop least recently used sizes until we are within the limit
+        while self.getSurfaceCount() > maxSurfaces:
+            candidates = [key for key in self.entries if key != keep]
+            if not candidates:
+                break
+            oldest = min(candidates, key=lambda key: self.lastUsed.get(key, 0))
+            self.remove(oldest)
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        self.positions.pop(key, None)
+        self.lastUsed.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.positions.clear()
+        self.lastUsed.clear()
+
+    def getStats(self):
+        return {
+            "surfaces": self.getSurfaceCount(),
+            "peak": self.peak,
+            "allocated": self.allocated,
+            "reused": self.reused,
+        }
+
+
+def freezeValue(value):
+    #Converts uniform values into something that can be compared later
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    if isinstance(value, dict):
+        return tuple(sorted([(key, freezeValue(v)) for key, v in value.items()]))
+    if isinstance(value, euclid.Matrix4):
+        return tuple(utils.matrixToList(value))
+    try:
+        return tuple([freezeValue(v) for v in value])
+    except TypeError:
+        return repr(value)
+
+
+class FrameScheduler:
+    #Skips rendering and readback when none of the inputs of a displayable
+    #have changed since the last rendered frame. Shaders that use time are
+    #only considered changed effectFps times per second.
+
+    TIME_UNIFORMS = ("shownTime", "animationTime")
+
+    def __init__(self, enabled=False, effectFps=None):
+        self.enabled = enabled
+        self.effectFps = effectFps
+        self.lastKey = None
+        self.settleFrames = 0
+        self.rendered = 0
+        self.skipped = 0
+
+    def reset(self):
+        self.lastKey = None
+
+    def createKey(self, renderer, context):
+        uniforms = {}
+        for name, value in context.uniforms.items():
+            if renderer.shader.hasUniform(name) and not name in self.TIME_UNIFORMS:
+                uniforms[name] = value
+
+        times = None
+        if renderer.isTimeDependent():
+            times = (context.shownTime, context.animationTime)
+            if self.effectFps:
+                times = tuple([int(t * self.effectFps) for t in times])
+
+        return (freezeValue(uniforms), times, renderer.getStateKey(), renderer.getInputKey())
+
+    def needsRender(self, renderer, context):
+        if not self.enabled:
+            return True
+
+        key = self.createKey(renderer, context)
+        if key != self.lastKey:
+            self.lastKey = key
+            #Asynchronous readback lags behind, keep going until the latest frame is out
+            self.settleFrames = shader.config.asyncReadbackBuffers if shader.config.asyncReadback else 0
+        elif self.settleFrames > 0:
+            self.settleFrames -= 1
+        else:
+            self.skipped += 1
+            return False
+
+        self.rendered += 1
+        return True
+
+    def getStats(self):
+        return {"rendered": self.rendered, "skipped": self.skipped}
+
+
+def createFrameKey(tag, renderer, context):
+    #Times are left out, caching is only used for displayables whose
+    #output depends on the other inputs alone. Time dependent output is
+    #only cached once the update callback has stopped rendering, which
+    #marks an end state like a finished fade.
+    rendererKey = renderer.getCacheKey()
+    if rendererKey is None:
+        return None
+
+    final = None
+    if renderer.isTimeDependent():
+        if context.continueRendering:
+            return None
+        final = "final"
+
+    uniforms = {}
+    for name, value in context.uniforms.items():
+        if renderer.shader.hasUniform(name) and not name in FrameScheduler.TIME_UNIFORMS:
+            uniforms[name] = value
+
+    return (tag, freezeValue(uniforms), renderer.getStateKey(), rendererKey, (context.width, context.height), final)
+
+
+class FrameCache:
+    #Finished frames of deterministic displayables, so showing the same
+    #thing again needs no rendering at all. Least recently used frames
+    #are dropped first when over the memory budget.
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.frames = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getByteSize(self, surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def get(self, key):
+        surface = self.frames.pop(key, None)
+        if surface is None:
+            self.misses += 1
+            return None
+
+        #Move to the most recently used end
+        self.frames[key] = surface
+        self.hits += 1
+        return surface
+
+    def add(self, key, surface):
+        old = self.frames.pop(key, None)
+        if old is not None:
+            self.bytes -= self.getByteSize(old)
+
+        self.frames[key] = surface
+        self.bytes += self.getByteSize(surface)
+
+        while self.bytes > self.budget and self.frames:
+            oldKey, old = self.frames.popitem(last=False)
+            self.bytes -= self.getByteSize(old)
+            self.evictions += 1
+
+    def clear(self):
+        self.frames.clear()
+        self.bytes = 0
+
+    def getStats(self):
+        return {
+            "frames": len(self.frames),
+            "bytes": self.bytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
 class ControllerContext:
     def __init__(self):
         self.controller = None
+        self.surfacePool = SurfacePool(shader.config.surfacePoolSize)
+        self.scheduler = FrameScheduler()
+        self.lastFrame = None
+        self.lastFrameSize = None
+        self.priority = 0
+        self.renderCost = None #Average seconds per rendered frame
+        self.lastRendered = 0
+        self.fps = None #Chosen by the frame budget, None uses config.fps
         self.createCalled = False
         self.contextStore = {}
         self.mousePos = (0, 0)
@@ -46,6 +290,11 @@ class ControllerContext:
         if self.controller and self.modeChangeCount == shader.getModeChangeCount():
             self.controller.free()
         self.controller = None
+        self.lastFrame = None
+        self.lastFrameSize = None
+        self.scheduler.reset()
+        self.renderCost = None
+        self.fps = None
 
 
 class ControllerContextStore:
@@ -64,8 +313,78 @@ class ControllerContextStore:
 
     def removeContext(self, tag):
         if tag in self.store:
+            self.store[tag].surfacePool.clear()
             del self.store[tag]
 
+    def getSurfacePoolStats(self):
+        surfaces = 0
+        peak = 0
+        for context in self.store.values():
+            stats = context.surfacePool.getStats()
+            surfaces += stats["surfaces"]
+            peak = max(peak, stats["peak"])
+        return surfaces, peak
+
+    def recordRenderTime(self, context, seconds, now):
+        if context.renderCost is None:
+            context.renderCost = seconds
+        else:
+            context.renderCost = context.renderCost * 0.9 + seconds * 0.1
+        context.lastRendered = now
+        self.updateFrameRates(now)
+
+    def getFrameRateSteps(self):
+        #Even divisions of the full rate keep frame pacing regular
+        steps = []
+        divisor = 1
+        while shader.config.fps / float(divisor) >= shader.config.minFps:
+            steps.append(shader.config.fps / float(divisor))
+            divisor += 1
+        return steps or [shader.config.fps]
+
+    def updateFrameRates(self, now):
+        budget = shader.config.frameBudget
+        active = []
+        for context in self.store.values():
+            context.fps = None
+            if context.controller and context.renderCost is not None and now - context.lastRendered < 1.0:
+                active.append(context)
+
+        if budget is None or not active:
+            return
+
+        #Budget and load are in seconds of rendering per second
+        budget *= shader.config.fps
+        load = sum([c.renderCost * shader.config.fps for c in active])
+
+        #Slow down low priority displayables first, most expensive ones first within a priority
+        active.sort(key=lambda c: (c.priority, -c.renderCost))
+        steps = self.getFrameRateSteps()
+        for context in active:
+            fps = shader.config.fps
+            for step in steps[1:]:
+                if load <= budget:
+                    break
+                load -= context.renderCost * (fps - step)
+                fps = step
+            if fps != shader.config.fps:
+                context.fps = fps
+            if load <= budget:
+                break
+
+    def getRedrawDelay(self, context):
+        return 1.0 / (context.fps or shader.config.fps)
+
+    def getFrameRates(self):
+        #For debugging, (tag, priority, fps, milliseconds per frame) tuples
+        results = []
+        for tag, context in self.store.items():
+            if context.controller:
+                cost = context.renderCost * 1000.0 if context.renderCost is not None else None
+                results.append((tag, context.priority, context.fps or shader.config.fps, cost))
+        results.sort(key=lambda r: -r[1])
+        return results
+
     def getAllShaderDisplayables(self, displayType):
         displayables = []
         for disp in renpy.exports.scene_lists().get_all_displayables():
@@ -98,7 +417,14 @@ class ControllerContextStore:
             context.freeController()
             self.removeContext(tag)
 
-        shader.log("Controller count: %s" % len(self.store))
+        if not self.store:
+            #Nothing left that could reuse the render targets
+            shader.trimFrameBuffers()
+
+        surfaces, peak = self.getSurfacePoolStats()
+        frameBuffers = shader.getFrameBufferPoolStats()
+        shader.log("Controller count: %s, pooled surfaces: %s (peak per controller: %s), frame buffers: %s free, %s high-water" %
+            (len(self.store), surfaces, peak, frameBuffers["free"], frameBuffers["highWater"]))
 
     def _clear(self):
         #Usually there is no need to call this in normal use
@@ -108,17 +434,115 @@ class ControllerContextStore:
         self.store.clear()
 
 
+class TextureOutput:
+    #Copies the rendered image into a texture owned by Ren'Py so the result
+    #can be drawn without reading it back to the CPU. Depends on Ren'Py GL
+    #renderer internals, so anything unexpected raises an error and the
+    #caller should fall back to the surface copy.
+
+    failed = False #Shared by all controllers, a failure would only repeat for the next one
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.grid = None
+        self.frameBuffer = None
+        self.shader = None
+
+        try:
+            self.create()
+        except:
+            self.free()
+            raise
+
+    def create(self):
+        width, height = self.width, self.height
+        surface = renpy.display.pgrender.surface((width, height), True)
+        self.grid = renpy.display.draw.load_texture(surface)
+
+        if len(self.grid.tiles) != 1 or len(self.grid.tiles[0]) != 1:
+            raise RuntimeError("Texture output requires a single texture tile")
+
+        tile = self.grid.tiles[0][0]
+        makeReady = getattr(tile, "make_ready", None)
+        if makeReady:
+            #Make sure a delayed upload won't overwrite our content later
+            makeReady()
+
+        self.frameBuffer = gpu.FrameBuffer(width, height, False, tile.number)
+        self.shader = shader.acquireProgram(shader.VS_2D, shader.PS_COPY_PREMULTIPLY)
+
+        vertices = [
+            -1, -1, 0.0, 0.0,
+            1, -1, 1.0, 0.0,
+            -1, 1, 0.0, 1.0,
+            1, 1, 1.0, 1.0,
+        ]
+        self.verts = (gl.GLfloat * len(vertices))(*vertices)
+
+    def free(self):
+        if self.frameBuffer:
+            self.frameBuffer.free()
+            self.frameBuffer = None
+
+        if self.shader:
+            shader.releaseProgram(self.shader)
+            self.shader = None
+
+        #Ren'Py frees the texture itself
+        self.grid = None
+
+    def update(self, texture):
+        #Ren'Py textures use premultiplied alpha
+        state = gpu.getState()
+        state.begin()
+
+        try:
+            self.frameBuffer.bind()
+            gl.glViewport(0, 0, self.width, self.height)
+            state.disable(gl.GL_BLEND)
+
+            self.shader.bind()
+            self.shader.uniformMatrix4f(shader.PROJECTION, utils.matrixToList(euclid.Matrix4()))
+            self.shader.uniformi(shader.TEX0, 0)
+
+            state.bindTexture(0, texture)
+
+            location = self.shader.getAttribLocation("inVertex")
+            gl.glVertexAttribPointer(location, 4, gl.GL_FLOAT, False, 0, self.verts)
+            gl.glEnableVertexAttribArray(location)
+            gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, 4)
+            gl.glDisableVertexAttribArray(location)
+        finally:
+            state.end()
+            self.frameBuffer.unbind()
+
+
+def blitFrame(render, frame, frameSize, size):
+    #Frames rendered at a lower resolution are stretched back to full size
+    if frameSize == size:
+        render.blit(frame, (0, 0))
+        return
+
+    scaled = renpy.display.render.Render(frameSize[0], frameSize[1])
+    scaled.blit(frame, (0, 0))
+    scaled.zoom(size[0] / float(frameSize[0]), size[1] / float(frameSize[1]))
+    render.blit(scaled, (0, 0))
+
+
 class RenderController(object):
     def __init__(self):
         self.renderer = None
         self.frameBuffer = None
+        self.pixelReader = None
+        self.textureOutput = None
+        self.renderScale = 1.0
+        self.autoScale = False
+        self.scaleCooldown = 0
 
     def init(self, renderer):
         self.renderer = renderer
 
-        w, h = self.renderer.getSize()
-        self.frameBuffer = gpu.FrameBuffer(w, h, renderer.useDepth)
-
     def isValid(self):
         return self.renderer is not None
 
@@ -127,43 +551,166 @@ class RenderController(object):
             self.renderer.free()
             self.renderer = None
 
-        if self.frameBuffer:
-            self.frameBuffer.free()
-            self.frameBuffer = None
+        self.releaseFrameBuffer()
+
+        if self.pixelReader:
+            self.pixelReader.free()
+            self.pixelReader = None
+
+        if self.textureOutput:
+            self.textureOutput.free()
+            self.textureOutput = None
 
     def getSize(self):
+        #Size of the image as seen by the shaders and Ren'Py
         return self.renderer.getSize()
 
-    def renderImage(self, context):
+    def getFrameSize(self):
+        #Size we actually render and read back
         width, height = self.getSize()
+        return max(int(width * self.renderScale), 1), max(int(height * self.renderScale), 1)
+
+    def setRenderScale(self, scale):
+        self.autoScale = scale == "auto"
+        if self.autoScale:
+            self.renderScale = 1.0
+        else:
+            self.renderScale = min(max(float(scale), shader.config.renderScaleMin), 1.0)
+
+    def updateRenderScale(self, seconds):
+        #Seconds should be a smoothed render cost, see ControllerContextStore.recordRenderTime().
+        #Adjust in coarse steps so render targets of every size don't pile up in the pool.
+        if not self.autoScale or seconds is None:
+            return
+
+        if self.scaleCooldown > 0:
+            #Let the average settle at the new scale before judging it
+            self.scaleCooldown -= 1
+            return
+
+        target = shader.config.renderScaleTarget
+        step = 1.0 / 16
+        scale = self.renderScale
+        if seconds > target * 1.1:
+            scale -= step
+        elif seconds < target * 0.7:
+            scale += step
+        scale = min(max(scale, shader.config.renderScaleMin), 1.0)
+
+        if scale != self.renderScale:
+            self.renderScale = scale
+            self.scaleCooldown = 30
+
+    def updateQuality(self, seconds):
+        self.renderer.updateQuality(seconds)
+
+    def acquireFrameBuffer(self):
+        #Render target is borrowed from the shared pool until the frame has been read back
+        if not self.frameBuffer:
+            width, height = self.getFrameSize()
+            self.frameBuffer = shader.acquireFrameBuffer(width, height, self.renderer.useDepth)
+
+    def releaseFrameBuffer(self):
+        if self.frameBuffer:
+            shader.releaseFrameBuffer(self.frameBuffer)
+            self.frameBuffer = None
+
+    def renderImage(self, context):
+        self.acquireFrameBuffer()
+
+        width, height = self.getFrameSize()
         gl.glViewport(0, 0, width, height)
 
-        gl.glDisable(gl.GL_SCISSOR_TEST)
+        state = gpu.getState()
+        state.begin()
+
+        state.disable(gl.GL_SCISSOR_TEST)
 
-        gl.glEnable(gl.GL_ALPHA_TEST)
-        gl.glAlphaFunc(gl.GL_GREATER, 0)
+        state.enable(gl.GL_ALPHA_TEST)
+        state.setAlphaFunc(gl.GL_GREATER, 0)
 
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        state.enable(gl.GL_BLEND)
+        state.setBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
         self.frameBuffer.bind()
+        context.frameBuffer = self.frameBuffer
 
         self.renderer.render(context)
 
         self.frameBuffer.unbind()
 
-        #TODO Restore blend state. Any other states that need restoring...?
-        gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA)
-
-    def copyRenderBufferToSurface(self, surface):
+        #Restores textures, program, blending etc.
+        state.end()
+
+    def copyRenderBuffer(self, surfacePool, final=False):
+        #Returns the rendered image as something that can be blitted into a Render.
+        #Final is the last frame before rendering stops, it must not lag behind.
+        if self.copyRenderBufferToTexture():
+            return self.textureOutput.grid
+
+        width, height = self.getFrameSize()
+        surface = surfacePool.get(width, height)
+        self.copyRenderBufferToSurface(surface, final)
+        #Pooled surfaces have been blitted before, Ren'Py must not reuse the old texture
+        renpy.display.render.mutated_surface(surface)
+        return surface
+
+    def copyRenderBufferToNewSurface(self):
+        #For surfaces that are kept around, not pooled
+        width, height = self.getFrameSize()
+        surface = renpy.display.pgrender.surface((width, height), True)
+        self.copyRenderBufferToSurfaceSync(surface)
+        return surface
+
+    def copyRenderBufferToTexture(self):
+        #Returns False if texture output can't be used and the caller
+        #should copy the image to a surface instead.
+        if not shader.config.textureOutput or TextureOutput.failed:
+            return False
+
+        width, height = self.getFrameSize()
+        if self.textureOutput and (self.textureOutput.width, self.textureOutput.height) != (width, height):
+            #Render scale has changed
+            self.textureOutput.free()
+            self.textureOutput = None
+
+        try:
+            if not self.textureOutput:
+                self.textureOutput = TextureOutput(width, height)
+            self.textureOutput.update(self.frameBuffer.texture)
+        except (AttributeError, TypeError, RuntimeError, gl.GLError) as e:
+            shader.log("Texture output not available, using surface copy: %s" % e)
+            TextureOutput.failed = True
+            if self.textureOutput:
+                self.textureOutput.free()
+                self.textureOutput = None
+            return False
+
+        return True
+
+    def copyRenderBufferToSurface(self, surface, final=False):
+        if shader.config.asyncReadback and gpu.isPixelBufferSupported() and not final:
+            if not self.pixelReader:
+                self.pixelReader = gpu.PixelBufferReader(shader.config.asyncReadbackBuffers)
+            if self.pixelReader.read(self.frameBuffer.texture, surface):
+                return
+        elif self.pixelReader:
+            #Queued frames are older than this one
+            self.pixelReader.discard()
+
+        #Synchronous fallback, also used until the first asynchronous read is ready
+        self.copyRenderBufferToSurfaceSync(surface)
+
+    def copyRenderBufferToSurfaceSync(self, surface):
         surface.lock()
 
         gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, surface.get_pitch() // surface.get_bytesize())
 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.frameBuffer.texture)
+        state = gpu.getState()
+        state.bindTexture(0, self.frameBuffer.texture)
         gl.glGetTexImage(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, surface._pixels_address)
 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        state.bindTexture(0, 0)
         gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, 0)
 
         surface.unlock()
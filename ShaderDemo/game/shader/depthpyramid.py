@@ -0,0 +1,97 @@
+
+import ctypes
+import math
+import renpy
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Min-depth pyramid for the PS_DEFERRED shadows. Each level halves the
+#previous one and keeps the nearest depth of the 2x2 pixels below it, so the
+#shadow ray can skip a whole cell when it stays behind that depth. Levels
+#from 1 upwards are packed side by side into one texture, see getLevelOffset().
+#Depth is stored like in the depth map: the value is (r + g + b) / 3, which
+#keeps the full precision of the source image.
+
+SAMPLER = "depthPyramid"
+
+def isSupported():
+    return numpy is not None
+
+def getLevelCount(width, height):
+    #Levels until one texel covers the whole image
+    return max(int(math.ceil(math.log(max(width, height, 2), 2))), 1)
+
+def getLevelOffset(width, level):
+    #Leaves room for the rounded up size of every level, the shader uses the same formula
+    return int(math.ceil(width * (1.0 - 2.0 ** (1 - level)))) + level - 1
+
+def getPyramidSize(width, height):
+    levels = getLevelCount(width, height)
+    return getLevelOffset(width, levels + 1), (height + 1) // 2
+
+def readDepthSums(surface):
+    #Sum of the color channels of every pixel, from 0 to 765
+    width, height = surface.get_size()
+    pitch = surface.get_pitch()
+    surface.lock()
+    try:
+        data = (ctypes.c_ubyte * (pitch * height)).from_address(surface._pixels_address)
+        pixels = numpy.ctypeslib.as_array(data).reshape(height, pitch)
+        pixels = pixels[:, :width * 4].reshape(height, width, 4)
+        return pixels[:, :, :3].astype(numpy.uint16).sum(axis=2)
+    finally:
+        surface.unlock()
+
+def downsample(depth):
+    height, width = depth.shape
+    if width % 2 or height % 2:
+        depth = numpy.pad(depth, ((0, height % 2), (0, width % 2)), "edge")
+    height, width = depth.shape
+    return depth.reshape(height // 2, 2, width // 2, 2).min(axis=3).min(axis=1)
+
+def encodeDepthSums(depth):
+    texels = numpy.empty(depth.shape + (4,), numpy.uint8)
+    texels[:, :, 0] = numpy.clip(depth, 0, 255)
+    texels[:, :, 1] = numpy.clip(depth.astype(numpy.int32) - 255, 0, 255)
+    texels[:, :, 2] = numpy.clip(depth.astype(numpy.int32) - 510, 0, 255)
+    texels[:, :, 3] = 255
+    return texels
+
+def createPyramid(depth):
+    height, width = depth.shape
+    pyramidWidth, pyramidHeight = getPyramidSize(width, height)
+    pyramid = numpy.zeros((pyramidHeight, pyramidWidth, 4), numpy.uint8)
+
+    level = depth
+    for i in range(1, getLevelCount(width, height) + 1):
+        level = downsample(level)
+        x = getLevelOffset(width, i)
+        pyramid[:level.shape[0], x:x + level.shape[1]] = encodeDepthSums(level)
+    return pyramid
+
+def createPyramidSurface(depthSurface):
+    pyramid = createPyramid(readDepthSums(depthSurface))
+    height, width = pyramid.shape[:2]
+
+    #Same RGBA byte order the textures are uploaded with
+    surface = renpy.display.pgrender.surface((width, height), True)
+    pitch = surface.get_pitch()
+    surface.lock()
+    try:
+        data = (ctypes.c_ubyte * (pitch * height)).from_address(surface._pixels_address)
+        pixels = numpy.ctypeslib.as_array(data).reshape(height, pitch)
+        pixels[:, :width * 4] = pyramid.reshape(height, width * 4)
+    finally:
+        surface.unlock()
+    return surface
+
+def getUniforms(depthTexture, pyramidTexture):
+    width, height = depthTexture.width, depthTexture.height
+    return {
+        "depthPyramidBase": (float(width), float(height)),
+        "depthPyramidSize": (float(pyramidTexture.width), float(pyramidTexture.height)),
+        "depthPyramidLevels": (float(getLevelCount(width, height)),),
+    }
@@ -1,4 +1,13 @@
 
+from buffers import BufferObject, VertexArray, GeometryBuffer, isBufferSupported, isVertexArraySupported, isInstancingSupported
 from framebuffer import FrameBuffer
+from framebufferpool import FrameBufferPool
+from pixelbuffer import PixelBufferReader, isPixelBufferSupported
 from shaderprogram import ShaderProgram
+from programcache import ProgramCache
+from programbinary import ProgramBinaryCache, isProgramBinarySupported
 from texture import Texture
+from texturecache import TextureCache
+from glstate import GLState, getState
+from datatexture import DataTexture, isDataTextureSupported, isFloatTextureSupported
+from glrecorder import GLRecorder
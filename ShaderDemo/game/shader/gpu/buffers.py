@@ -0,0 +1,173 @@
+
+import ctypes
+from OpenGL import GL as gl
+
+def isBufferSupported():
+    return bool(gl.glGenBuffers)
+
+def isVertexArraySupported():
+    return bool(gl.glGenVertexArrays)
+
+def isInstancingSupported():
+    return bool(gl.glDrawElementsInstanced)
+
+class BufferObject:
+    def __init__(self, target, usage=gl.GL_STATIC_DRAW):
+        self.target = target
+        self.usage = usage
+        self.size = 0
+
+        bufferId = (gl.GLuint * 1)()
+        gl.glGenBuffers(1, bufferId)
+        self.handle = bufferId[0]
+        if self.handle == 0:
+            raise RuntimeError("Can't create buffer object")
+
+    def free(self):
+        if self.handle:
+            gl.glDeleteBuffers(1, (gl.GLuint * 1)(self.handle))
+            self.handle = 0
+        self.size = 0
+
+    def upload(self, data):
+        self.size = ctypes.sizeof(data)
+        gl.glBindBuffer(self.target, self.handle)
+        gl.glBufferData(self.target, self.size, data, self.usage)
+        gl.glBindBuffer(self.target, 0)
+
+    def bind(self):
+        gl.glBindBuffer(self.target, self.handle)
+
+    def unbind(self):
+        gl.glBindBuffer(self.target, 0)
+
+class VertexArray:
+    def __init__(self):
+        arrayId = (gl.GLuint * 1)()
+        gl.glGenVertexArrays(1, arrayId)
+        self.handle = arrayId[0]
+        if self.handle == 0:
+            raise RuntimeError("Can't create vertex array object")
+
+    def free(self):
+        if self.handle:
+            gl.glDeleteVertexArrays(1, (gl.GLuint * 1)(self.handle))
+            self.handle = 0
+
+    def bind(self):
+        gl.glBindVertexArray(self.handle)
+
+    def unbind(self):
+        gl.glBindVertexArray(0)
+
+class GeometryBuffer:
+    def __init__(self, useVertexArray=True):
+        self.source = None
+        self.version = -1
+        self.attributes = []
+        self.indexBuffer = None
+        self.indexCount = 0
+        self.vertexArray = None
+        self.recordedProgram = None
+        self.recordedLocations = []
+
+        if useVertexArray and isVertexArraySupported():
+            self.vertexArray = VertexArray()
+
+    def free(self):
+        self.freeBuffers()
+        if self.vertexArray:
+            self.vertexArray.free()
+            self.vertexArray = None
+
+    def freeBuffers(self):
+        for name, buffer, count in self.attributes:
+            buffer.free()
+        self.attributes = []
+
+        if self.indexBuffer:
+            self.indexBuffer.free()
+            self.indexBuffer = None
+        self.indexCount = 0
+
+        self.source = None
+        self.version = -1
+        self.recordedProgram = None
+        self.recordedLocations = []
+
+    def isCurrent(self, source, version):
+        return self.source is source and self.version == version
+
+    def upload(self, source, version, attributes, indices=None):
+        #Attributes is a list of (name, data, componentCount) tuples
+        self.freeBuffers()
+
+        for name, data, count in attributes:
+            if data is not None:
+                buffer = BufferObject(gl.GL_ARRAY_BUFFER)
+                buffer.upload(data)
+                self.attributes.append((name, buffer, count))
+
+        if indices is not None:
+            self.indexBuffer = BufferObject(gl.GL_ELEMENT_ARRAY_BUFFER)
+            self.indexBuffer.upload(indices)
+            self.indexCount = len(indices)
+
+        self.source = source
+        self.version = version
+
+    def bindAttributes(self, program):
+        locations = []
+        for name, buffer, count in self.attributes:
+            location = program.getAttribLocation(name)
+            if location != -1:
+                buffer.bind()
+                gl.glVertexAttribPointer(location, count, gl.GL_FLOAT, False, 0, None)
+                gl.glEnableVertexAttribArray(location)
+                locations.append(location)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+        if self.indexBuffer:
+            self.indexBuffer.bind()
+        return locations
+
+    def bind(self, program):
+        if self.vertexArray:
+            self.vertexArray.bind()
+            if self.recordedProgram is not program:
+                #Attribute locations depend on the program, record them again.
+                #Compared by object because a new program can get the handle
+                #of a freed one.
+                for location in self.recordedLocations:
+                    gl.glDisableVertexAttribArray(location)
+                self.recordedLocations = self.bindAttributes(program)
+                self.recordedProgram = program
+        else:
+            self.bindAttributes(program)
+
+    def unbind(self, program):
+        if self.vertexArray:
+            self.vertexArray.unbind()
+        else:
+            for name, buffer, count in self.attributes:
+                location = program.getAttribLocation(name)
+                if location != -1:
+                    gl.glDisableVertexAttribArray(location)
+
+        #Element array binding is part of the vertex array state, so
+        #this only matters when we are not using one.
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    def drawElements(self, mode, first=0, count=None, instances=1):
+        if count is None:
+            count = self.indexCount - first
+        offset = None
+        if first:
+            offset = ctypes.c_void_p(first * ctypes.sizeof(gl.GLuint))
+        if instances > 1:
+            gl.glDrawElementsInstanced(mode, count, gl.GL_UNSIGNED_INT, offset, instances)
+        else:
+            gl.glDrawElements(mode, count, gl.GL_UNSIGNED_INT, offset)
+
+    def drawArrays(self, mode, count):
+        gl.glDrawArrays(mode, 0, count)
@@ -0,0 +1,104 @@
+
+import ctypes
+from OpenGL import GL as gl
+import glstate
+
+def isFloatTextureSupported():
+    #Core since OpenGL 3.0
+    version = gl.glGetString(gl.GL_VERSION)
+    try:
+        return int(version.split(b".")[0]) >= 3
+    except (ValueError, AttributeError):
+        return False
+
+def isDataTextureSupported():
+    #Float textures that can be read in vertex shaders
+    if not isFloatTextureSupported():
+        return False
+    try:
+        units = gl.glGetIntegerv(gl.GL_MAX_VERTEX_TEXTURE_IMAGE_UNITS)
+    except gl.GLError:
+        return False
+    return units > 0
+
+class DataTexture:
+    #Rows of RGBA float texels, like one row per bone. Rows that have not
+    #changed since the last update are not uploaded again and the texture
+    #grows when more rows are needed.
+
+    def __init__(self, columns, unit):
+        self.columns = columns
+        self.unit = unit
+        self.rows = 0
+        self.textureId = 0
+        self.data = []
+        self.rowsUploaded = 0
+        self.rangesUploaded = 0
+
+    def free(self):
+        if self.textureId:
+            gl.glDeleteTextures(1, self.textureId)
+            glstate.getState().forgetTexture(self.textureId)
+            self.textureId = 0
+        self.rows = 0
+        self.data = []
+
+    def valid(self):
+        return self.textureId != 0
+
+    def allocate(self, rows):
+        self.free()
+
+        #Round up so small changes in the row count don't reallocate
+        self.rows = max(16, 1 << (rows - 1).bit_length())
+
+        textureId = (gl.GLuint * 1)()
+        gl.glGenTextures(1, textureId)
+        self.textureId = textureId[0]
+
+        self.bindForUpload()
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA32F, self.columns, self.rows, 0, gl.GL_RGBA, gl.GL_FLOAT, None)
+
+    def bindForUpload(self):
+        state = glstate.getState()
+        state.bindTexture(self.unit, self.textureId)
+        state.setActiveTexture(self.unit)
+
+    def update(self, rows):
+        #Rows are sequences of columns * 4 floats
+        if len(rows) > self.rows or not self.textureId:
+            self.allocate(len(rows))
+
+        start = None
+        for i, row in enumerate(rows):
+            changed = i >= len(self.data) or self.data[i] != row
+            if changed and start is None:
+                start = i
+            elif not changed and start is not None:
+                self.uploadRows(rows, start, i)
+                start = None
+        if start is not None:
+            self.uploadRows(rows, start, len(rows))
+
+        self.data = list(rows)
+
+    def uploadRows(self, rows, start, end):
+        values = []
+        for row in rows[start:end]:
+            values.extend(row)
+
+        self.bindForUpload()
+        gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, start, self.columns, end - start, gl.GL_RGBA, gl.GL_FLOAT,
+            (ctypes.c_float * len(values))(*values))
+        self.rowsUploaded += end - start
+        self.rangesUploaded += 1
+
+    def bind(self):
+        glstate.getState().bindTexture(self.unit, self.textureId)
+
+    def getStats(self):
+        return {"rows": self.rows, "rowsUploaded": self.rowsUploaded, "rangesUploaded": self.rangesUploaded}
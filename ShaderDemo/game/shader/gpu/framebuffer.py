@@ -1,9 +1,14 @@
 
 from OpenGL import GL as gl
+import glstate
 
 class FrameBuffer:
-    def __init__(self, width, height, depth=False):
-        self.texture = self.createEmptyTexture(width, height)
+    def __init__(self, width, height, depth=False, texture=0):
+        #If a texture is given it is used as the color target, but it is not owned by us
+        self.width = width
+        self.height = height
+        self.ownsTexture = not texture
+        self.texture = texture or self.createEmptyTexture(width, height)
         if self.texture == 0:
             raise RuntimeError("Can't create FrameBuffer textures")
 
@@ -19,7 +24,9 @@ class FrameBuffer:
 
     def free(self):
         if self.texture:
-            gl.glDeleteTextures(1, self.texture)
+            if self.ownsTexture:
+                gl.glDeleteTextures(1, self.texture)
+                glstate.getState().forgetTexture(self.texture)
             self.texture = 0
         if self.depthBuffer:
             gl.glDeleteRenderbuffers(1, self.depthBuffer)
@@ -30,15 +37,17 @@ class FrameBuffer:
 
     def createEmptyTexture(self, width, height):
         textureId = (gl.GLuint * 1)()
+        state = glstate.getState()
         gl.glGenTextures(1, textureId)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, textureId[0])
+        state.setActiveTexture(0)
+        state.bindTexture(0, textureId[0])
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
         #None means reserve texture memory, but texels are undefined
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, width, height, 0, gl.GL_BGRA, gl.GL_UNSIGNED_BYTE, None)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        state.bindTexture(0, 0)
         return textureId[0]
 
     def createDepthBuffer(self, width, height):
@@ -64,3 +73,11 @@ class FrameBuffer:
 
     def unbind(self):
         gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+    def setFilter(self, filter):
+        #Render targets are created with nearest filtering, sampling them smoothly needs linear
+        state = glstate.getState()
+        state.bindTexture(0, self.texture)
+        state.setActiveTexture(0)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, filter)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, filter)
@@ -0,0 +1,76 @@
+
+from framebuffer import FrameBuffer
+
+class FrameBufferPool:
+    #Render targets are only borrowed while a frame is rendered and read
+    #back, so displayables of the same size can share them. Returned
+    #targets are kept for reuse up to maxFree per size.
+
+    def __init__(self, maxFree):
+        self.maxFree = maxFree
+        self.free = {}
+        self.generation = None
+        self.borrowed = 0
+        self.highWater = 0
+        self.allocations = 0
+        self.reuses = 0
+        self.trimmed = 0
+
+    def checkGeneration(self, generation):
+        if generation != self.generation:
+            #OpenGL context has been reset, old handles are no longer valid
+            self.free.clear()
+            self.borrowed = 0
+            self.generation = generation
+
+    def makeKey(self, width, height, depth):
+        return (width, height, bool(depth))
+
+    def acquire(self, width, height, depth, generation):
+        self.checkGeneration(generation)
+
+        buffers = self.free.get(self.makeKey(width, height, depth))
+        if buffers:
+            frameBuffer = buffers.pop()
+            self.reuses += 1
+        else:
+            frameBuffer = FrameBuffer(width, height, depth)
+            self.allocations += 1
+
+        self.borrowed += 1
+        self.highWater = max(self.highWater, self.borrowed + self.getFreeCount())
+        return frameBuffer
+
+    def release(self, frameBuffer, generation):
+        if generation != self.generation:
+            #Belongs to an earlier context, nothing to free
+            return
+
+        self.borrowed = max(self.borrowed - 1, 0)
+        key = self.makeKey(frameBuffer.width, frameBuffer.height, frameBuffer.depthBuffer)
+        self.free.setdefault(key, []).append(frameBuffer)
+        self.trim(self.maxFree)
+
+    def trim(self, maxFree=0):
+        for key, buffers in self.free.items():
+            while len(buffers) > maxFree:
+                buffers.pop(0).free()
+                self.trimmed += 1
+            if not buffers:
+                del self.free[key]
+
+    def clear(self):
+        self.trim(0)
+
+    def getFreeCount(self):
+        return sum([len(buffers) for buffers in self.free.values()])
+
+    def getStats(self):
+        return {
+            "borrowed": self.borrowed,
+            "free": self.getFreeCount(),
+            "highWater": self.highWater,
+            "allocations": self.allocations,
+            "reuses": self.reuses,
+            "trimmed": self.trimmed,
+        }
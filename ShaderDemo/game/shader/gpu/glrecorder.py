@@ -0,0 +1,154 @@
+
+import json
+import collections
+from OpenGL import GL as gl
+
+DRAW_CALLS = set(["glDrawArrays", "glDrawElements", "glDrawArraysInstanced", "glDrawElementsInstanced"])
+
+STATE_CHANGES = set([
+    "glEnable", "glDisable", "glBlendFunc", "glAlphaFunc", "glPolygonMode", "glViewport",
+    "glActiveTexture", "glBindTexture", "glUseProgram", "glBindBuffer", "glBindVertexArray",
+    "glBindFramebuffer", "glBindRenderbuffer", "glEnableVertexAttribArray",
+    "glDisableVertexAttribArray", "glVertexAttribPointer", "glPixelStorei", "glTexParameteri",
+])
+
+TEXTURE_UPLOADS = set(["glTexImage2D", "glTexSubImage2D"])
+BUFFER_UPLOADS = set(["glBufferData", "glBufferSubData"])
+
+COUNTERS = ["calls", "drawCalls", "stateChanges", "uniformUploads", "textureUploads", "textureBytes", "bufferBytes"]
+
+def getTexelBytes(type):
+    if type == gl.GL_FLOAT:
+        return 16
+    return 4
+
+def getTextureBytes(name, args):
+    #Only uploads with data count, allocating storage is not a transfer
+    if name == "glTexImage2D" and len(args) > 8 and args[8] is not None:
+        return args[3] * args[4] * getTexelBytes(args[7])
+    if name == "glTexSubImage2D" and len(args) > 8 and args[8] is not None:
+        return args[4] * args[5] * getTexelBytes(args[7])
+    return 0
+
+def getBufferBytes(name, args):
+    if name == "glBufferData" and len(args) > 2 and args[2] is not None:
+        return args[1]
+    if name == "glBufferSubData" and len(args) > 3:
+        return args[2]
+    return 0
+
+class RecordedFunction:
+    def __init__(self, recorder, name, function):
+        self.recorder = recorder
+        self.name = name
+        self.function = function
+
+    def __call__(self, *args, **kwargs):
+        self.recorder.record(self.name, args)
+        return self.function(*args, **kwargs)
+
+    def __nonzero__(self):
+        #Keeps the null function checks of PyOpenGL working
+        return bool(self.function)
+
+class FrameRecord:
+    def __init__(self):
+        self.counters = dict([(name, 0) for name in COUNTERS])
+        self.functions = collections.Counter()
+
+class GLRecorder:
+    #Stands in for the OpenGL module and counts every call made through it.
+    #Counts are deterministic for a given scene, unlike timings, so they can
+    #be compared between runs and checked against budgets.
+
+    def __init__(self, target=gl):
+        self.target = target
+        self.wrappers = {}
+        self.installed = []
+        self.reset()
+
+    def __getattr__(self, name):
+        value = getattr(self.target, name)
+        if not name.startswith("gl") or not callable(value):
+            #Constants, types and exceptions
+            return value
+
+        wrapper = self.wrappers.get(name)
+        if not wrapper:
+            wrapper = RecordedFunction(self, name, value)
+            self.wrappers[name] = wrapper
+        return wrapper
+
+    def reset(self):
+        self.frames = []
+        self.frame = FrameRecord()
+
+    def record(self, name, args):
+        counters = self.frame.counters
+        counters["calls"] += 1
+        self.frame.functions[name] += 1
+
+        if name in DRAW_CALLS:
+            counters["drawCalls"] += 1
+        elif name in STATE_CHANGES:
+            counters["stateChanges"] += 1
+        elif name.startswith("glUniform"):
+            counters["uniformUploads"] += 1
+        elif name in TEXTURE_UPLOADS:
+            textureBytes = getTextureBytes(name, args)
+            if textureBytes:
+                counters["textureUploads"] += 1
+                counters["textureBytes"] += textureBytes
+        elif name in BUFFER_UPLOADS:
+            counters["bufferBytes"] += getBufferBytes(name, args)
+
+    def endFrame(self):
+        self.frames.append(self.frame)
+        self.frame = FrameRecord()
+
+    def install(self, modules):
+        #Points the 'gl' name of the given modules at this recorder
+        for module in modules:
+            if getattr(module, "gl", None) is not self:
+                self.installed.append((module, module.gl))
+                module.gl = self
+
+    def uninstall(self):
+        for module, original in reversed(self.installed):
+            module.gl = original
+        self.installed = []
+
+    def getSummary(self):
+        #Per frame mean and max of every counter, plus total calls per function
+        frames = {}
+        for name in COUNTERS:
+            values = [frame.counters[name] for frame in self.frames] or [0]
+            frames[name] = {
+                "mean": sum(values) / float(len(values)),
+                "max": max(values),
+            }
+
+        functions = collections.Counter()
+        for frame in self.frames:
+            functions.update(frame.functions)
+
+        return {
+            "frames": len(self.frames),
+            "perFrame": frames,
+            "functions": dict(functions),
+        }
+
+    def checkBudgets(self, budgets):
+        #Budgets map counter names to the most a single frame may use. Returns failure messages.
+        failures = []
+        summary = self.getSummary()["perFrame"]
+        for name, budget in sorted(budgets.items()):
+            if name not in summary:
+                failures.append("Unknown GL counter: %s" % name)
+            elif summary[name]["max"] > budget:
+                failures.append("%s: %i per frame, budget is %i" % (name, summary[name]["max"], budget))
+        return failures
+
+    def exportJson(self, path):
+        with open(path, "w") as f:
+            json.dump(self.getSummary(), f, indent=4, sort_keys=True)
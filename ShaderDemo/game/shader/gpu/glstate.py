@@ -0,0 +1,114 @@
+
+from OpenGL import GL as gl
+
+class GLState:
+    #Remembers the OpenGL state we have set and skips calls that would not
+    #change it. Ren'Py can change the state behind our back, so the cached
+    #values are only trusted between begin() and end(). Outside of that
+    #every call is issued normally.
+
+    def __init__(self):
+        self.active = False
+        self.issued = 0
+        self.elided = 0
+        self.invalidate()
+
+    def invalidate(self):
+        #Forget everything, the next call of each kind is always issued
+        self.capabilities = {}
+        self.blendFunc = None
+        self.alphaFunc = None
+        self.activeUnit = None
+        self.textures = {}
+        self.program = None
+
+    def begin(self):
+        self.invalidate()
+        self.active = True
+
+    def end(self):
+        #Restore the state Ren'Py expects once, instead of after every draw
+        for unit, textureId in self.textures.items():
+            if textureId != 0:
+                self.bindTexture(unit, 0)
+        self.setActiveTexture(0)
+        self.useProgram(0)
+
+        self.disable(gl.GL_DEPTH_TEST)
+        self.enable(gl.GL_BLEND)
+        self.setBlendFunc(gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+        self.active = False
+        self.invalidate()
+
+    def _changes(self, current, value):
+        if self.active and current == value:
+            self.elided += 1
+            return False
+        self.issued += 1
+        return True
+
+    def setCapability(self, capability, enabled):
+        if self._changes(self.capabilities.get(capability), enabled):
+            if enabled:
+                gl.glEnable(capability)
+            else:
+                gl.glDisable(capability)
+            self.capabilities[capability] = enabled
+
+    def enable(self, capability):
+        self.setCapability(capability, True)
+
+    def disable(self, capability):
+        self.setCapability(capability, False)
+
+    def setBlendFunc(self, source, destination):
+        func = (source, destination)
+        if self._changes(self.blendFunc, func):
+            gl.glBlendFunc(source, destination)
+            self.blendFunc = func
+
+    def setAlphaFunc(self, func, reference):
+        value = (func, reference)
+        if self._changes(self.alphaFunc, value):
+            gl.glAlphaFunc(func, reference)
+            self.alphaFunc = value
+
+    def setActiveTexture(self, unit):
+        if self._changes(self.activeUnit, unit):
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            self.activeUnit = unit
+
+    def bindTexture(self, unit, textureId):
+        #Note that the active texture unit is only changed if the binding is
+        if self._changes(self.textures.get(unit), textureId):
+            self.setActiveTexture(unit)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, textureId)
+            self.textures[unit] = textureId
+
+    def useProgram(self, handle):
+        if self._changes(self.program, handle):
+            gl.glUseProgram(handle)
+            self.program = handle
+
+    def forgetTexture(self, textureId):
+        #Deleted names can be reused by new objects
+        for unit, bound in self.textures.items():
+            if bound == textureId:
+                self.textures[unit] = None
+
+    def forgetProgram(self, handle):
+        if self.program == handle:
+            self.program = None
+
+    def getStats(self):
+        return {"issued": self.issued, "elided": self.elided}
+
+    def resetStats(self):
+        self.issued = 0
+        self.elided = 0
+
+_state = GLState()
+
+def getState():
+    return _state
@@ -0,0 +1,93 @@
+
+import ctypes
+from OpenGL import GL as gl
+import glstate
+
+def isPixelBufferSupported():
+    return bool(gl.glGenBuffers) and bool(gl.glMapBuffer)
+
+class PixelBufferReader:
+    #Reads texture data through a ring of pixel pack buffers. The read for
+    #the current frame is only queued and the data from the previous frame is
+    #copied out instead, so the CPU doesn't have to wait for the GPU.
+
+    def __init__(self, count=2):
+        self.count = count
+        self.buffers = []
+        self.index = 0
+        self.pending = 0
+        self.size = 0
+        self.rowLength = 0
+
+    def free(self):
+        if self.buffers:
+            gl.glDeleteBuffers(len(self.buffers), (gl.GLuint * len(self.buffers))(*self.buffers))
+        self.buffers = []
+        self.index = 0
+        self.pending = 0
+        self.size = 0
+        self.rowLength = 0
+
+    def discard(self):
+        #Forget queued reads, their frames are older than what has been shown
+        self.pending = 0
+
+    def allocate(self, size, rowLength):
+        self.free()
+
+        bufferIds = (gl.GLuint * self.count)()
+        gl.glGenBuffers(self.count, bufferIds)
+        for bufferId in bufferIds:
+            if bufferId == 0:
+                raise RuntimeError("Can't create pixel buffer")
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, bufferId)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None, gl.GL_STREAM_READ)
+            self.buffers.append(bufferId)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+        self.size = size
+        self.rowLength = rowLength
+
+    def queueRead(self, texture):
+        gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, self.rowLength)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.buffers[self.index])
+        state = glstate.getState()
+        state.setActiveTexture(0)
+        state.bindTexture(0, texture)
+        #With a pack buffer bound the last argument is an offset into it
+        gl.glGetTexImage(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+        state.bindTexture(0, 0)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, 0)
+
+        self.index = (self.index + 1) % self.count
+        self.pending = min(self.pending + 1, self.count)
+
+    def copyOldest(self, address):
+        #Oldest queued buffer is the one we will write into next
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.buffers[self.index])
+        pointer = gl.glMapBuffer(gl.GL_PIXEL_PACK_BUFFER, gl.GL_READ_ONLY)
+        if pointer:
+            ctypes.memmove(address, pointer, self.size)
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        return bool(pointer)
+
+    def read(self, texture, surface):
+        #Returns False if there was no previous frame available and
+        #the caller should read the texture synchronously instead.
+        rowLength = surface.get_pitch() // surface.get_bytesize()
+        size = surface.get_pitch() * surface.get_height()
+        if size != self.size or rowLength != self.rowLength:
+            self.allocate(size, rowLength)
+
+        self.queueRead(texture)
+
+        if self.pending < self.count:
+            return False
+
+        surface.lock()
+        try:
+            return self.copyOldest(surface._pixels_address)
+        finally:
+            surface.unlock()
@@ -0,0 +1,127 @@
+
+import os
+import ctypes
+import struct
+import hashlib
+from OpenGL import GL as gl
+
+MAGIC = "RSPB"
+VERSION = 1
+HEADER = "<4sIII" #Magic, version, binary format, binary length
+
+def isProgramBinarySupported():
+    if not gl.glGetProgramBinary or not gl.glProgramBinary:
+        return False
+    try:
+        return int(gl.glGetIntegerv(gl.GL_NUM_PROGRAM_BINARY_FORMATS)) > 0
+    except gl.GLError:
+        return False
+
+def getDriverIdentity():
+    parts = []
+    for name in (gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION):
+        parts.append(str(gl.glGetString(name)))
+    return "/".join(parts)
+
+class ProgramBinaryCache:
+    #Stores linked program binaries on disk so that later launches can
+    #skip compiling and linking. Any entry that fails to load is rebuilt.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.driver = None
+        self.loads = 0
+        self.loadTime = 0.0
+        self.builds = 0
+        self.buildTime = 0.0
+        self.rejected = 0
+
+    def makeKey(self, vsCode, psCode, defines):
+        if self.driver is None:
+            self.driver = getDriverIdentity()
+
+        h = hashlib.sha1()
+        for part in (self.driver, vsCode, psCode, repr(sorted((defines or {}).items()))):
+            h.update(part.encode("utf-8"))
+        return h.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def prepare(self, handle):
+        gl.glProgramParameteri(handle, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
+
+    def load(self, handle, key):
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+
+            headerSize = struct.calcsize(HEADER)
+            magic, version, binaryFormat, length = struct.unpack(HEADER, data[:headerSize])
+            binary = data[headerSize:]
+            if magic != MAGIC or version != VERSION or length != len(binary):
+                raise ValueError("Invalid program binary header")
+
+            gl.glProgramBinary(handle, binaryFormat, binary, length)
+            if gl.glGetProgramiv(handle, gl.GL_LINK_STATUS):
+                return True
+        except (IOError, ValueError, struct.error, gl.GLError):
+            pass
+
+        #Driver update, corrupted file etc. Remove it, it will be rebuilt.
+        self.rejected += 1
+        self.remove(path)
+        return False
+
+    def save(self, handle, key):
+        try:
+            size = int(gl.glGetProgramiv(handle, gl.GL_PROGRAM_BINARY_LENGTH))
+            if size <= 0:
+                return False
+
+            binary = ctypes.create_string_buffer(size)
+            length = gl.GLsizei(0)
+            binaryFormat = gl.GLenum(0)
+            gl.glGetProgramBinary(handle, size, ctypes.byref(length), ctypes.byref(binaryFormat), binary)
+
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+
+            path = self.getPath(key)
+            temp = path + ".tmp"
+            with open(temp, "wb") as f:
+                f.write(struct.pack(HEADER, MAGIC, VERSION, binaryFormat.value, length.value))
+                f.write(binary.raw[:length.value])
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp, path)
+            return True
+        except (IOError, OSError, gl.GLError):
+            return False
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def recordLoad(self, seconds):
+        self.loads += 1
+        self.loadTime += seconds
+
+    def recordBuild(self, seconds):
+        self.builds += 1
+        self.buildTime += seconds
+
+    def getStats(self):
+        return {
+            "loads": self.loads,
+            "loadTime": self.loadTime,
+            "builds": self.builds,
+            "buildTime": self.buildTime,
+            "rejected": self.rejected,
+        }
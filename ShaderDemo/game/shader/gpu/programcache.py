@@ -0,0 +1,66 @@
+
+from shaderprogram import ShaderProgram
+
+def makeKey(vsCode, psCode, defines):
+    return (vsCode, psCode, tuple(sorted((defines or {}).items())))
+
+class ProgramEntry:
+    def __init__(self, key, program):
+        self.key = key
+        self.program = program
+        self.refCount = 0
+
+class ProgramCache:
+    #Shares linked shader programs between renderers. Programs are
+    #reference counted and freed when the last user releases them.
+
+    def __init__(self):
+        self.entries = {}
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def checkGeneration(self, generation):
+        if generation != self.generation:
+            #OpenGL context has been reset, old handles are no longer valid
+            #and must not be deleted in the new context.
+            self.entries.clear()
+            self.generation = generation
+
+    def acquire(self, vsCode, psCode, generation, defines=None, binaryCache=None):
+        self.checkGeneration(generation)
+
+        key = makeKey(vsCode, psCode, defines)
+        entry = self.entries.get(key)
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = ProgramEntry(key, ShaderProgram(vsCode, psCode, defines, binaryCache))
+            self.entries[key] = entry
+
+        entry.refCount += 1
+        return entry.program
+
+    def release(self, program):
+        for key, entry in self.entries.items():
+            if entry.program is program:
+                entry.refCount -= 1
+                if entry.refCount <= 0:
+                    entry.program.free()
+                    del self.entries[key]
+                return
+        #Not found, belongs to an earlier generation
+
+    def clear(self):
+        for entry in self.entries.values():
+            entry.program.free()
+        self.entries.clear()
+
+    def getStats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "programs": len(self.entries),
+            "references": sum([e.refCount for e in self.entries.values()]),
+        }
@@ -1,6 +1,8 @@
 
+import time
 import ctypes
 from OpenGL import GL as gl
+import glstate
 
 #Possible compatibility defines for GLSL ES etc.
 DEFINES = """
@@ -9,13 +11,102 @@ DEFINES = """
 #define UNIFORM uniform
 """
 
-def wrapShaderCode(code):
-    return DEFINES + "\n\n" + code
+def wrapShaderCode(code, defines=None):
+    extra = ""
+    if defines:
+        for name, value in sorted(defines.items()):
+            extra += "#define %s %s\n" % (name, value)
+    return DEFINES + extra + "\n\n" + code
+
+SAMPLER_TYPES = set([
+    gl.GL_SAMPLER_1D,
+    gl.GL_SAMPLER_2D,
+    gl.GL_SAMPLER_3D,
+    gl.GL_SAMPLER_CUBE,
+])
+
+INT_TYPES = {
+    gl.GL_INT: 1,
+    gl.GL_INT_VEC2: 2,
+    gl.GL_INT_VEC3: 3,
+    gl.GL_INT_VEC4: 4,
+    gl.GL_BOOL: 1,
+    gl.GL_BOOL_VEC2: 2,
+    gl.GL_BOOL_VEC3: 3,
+    gl.GL_BOOL_VEC4: 4,
+}
+
+FLOAT_TYPES = {
+    gl.GL_FLOAT: 1,
+    gl.GL_FLOAT_VEC2: 2,
+    gl.GL_FLOAT_VEC3: 3,
+    gl.GL_FLOAT_VEC4: 4,
+}
+
+#Components and upload call of each matrix type
+MATRIX_TYPES = {
+    gl.GL_FLOAT_MAT2: (4, gl.glUniformMatrix2fv),
+    gl.GL_FLOAT_MAT3: (9, gl.glUniformMatrix3fv),
+    gl.GL_FLOAT_MAT4: (16, gl.glUniformMatrix4fv),
+}
+
+FLOAT_ARRAY_SETTERS = {
+    1: gl.glUniform1fv,
+    2: gl.glUniform2fv,
+    3: gl.glUniform3fv,
+    4: gl.glUniform4fv,
+}
+
+INT_ARRAY_SETTERS = {
+    1: gl.glUniform1iv,
+    2: gl.glUniform2iv,
+    3: gl.glUniform3iv,
+    4: gl.glUniform4iv,
+}
+
+def stripArrayName(name):
+    #Arrays are reported as "name[0]"
+    if name.endswith("[0]"):
+        return name[:-3]
+    return name
+
+class UniformInfo:
+    def __init__(self, name, location, size, type):
+        self.name = name
+        self.location = location
+        self.size = size
+        self.type = type
+        self.initial = None
+
+class AttributeInfo:
+    def __init__(self, name, location, size, type):
+        self.name = name
+        self.location = location
+        self.size = size
+        self.type = type
 
 class ShaderProgram:
-    def __init__(self, vsCode, psCode):
+    def __init__(self, vsCode, psCode, defines=None, binaryCache=None):
         self.handle = gl.glCreateProgram()
+        self.defines = defines
         self.linked = False
+        self.uniforms = {}
+        self.attributes = {}
+        self.values = {}
+        self.userUniforms = set()
+        self.uploadsIssued = 0
+        self.uploadsSkipped = 0
+
+        start = time.time()
+        key = None
+        if binaryCache:
+            key = binaryCache.makeKey(vsCode, psCode, defines)
+            if binaryCache.load(self.handle, key):
+                self.linked = True
+                self.reflect()
+                binaryCache.recordLoad(time.time() - start)
+                return
+            binaryCache.prepare(self.handle)
 
         self.createShader(vsCode, gl.GL_VERTEX_SHADER)
         self.createShader(psCode, gl.GL_FRAGMENT_SHADER)
@@ -25,9 +116,13 @@ class ShaderProgram:
         if not self.linked:
             raise RuntimeError("Shader not linked")
 
+        if binaryCache:
+            binaryCache.recordBuild(time.time() - start)
+            binaryCache.save(self.handle, key)
+
     def createShader(self, shaderCode, type):
         shader = gl.glCreateShader(type)
-        gl.glShaderSource(shader, wrapShaderCode(shaderCode))
+        gl.glShaderSource(shader, wrapShaderCode(shaderCode, self.defines))
         gl.glCompileShader(shader)
 
         status = gl.glGetShaderiv(shader, gl.GL_COMPILE_STATUS)
@@ -42,40 +137,194 @@ class ShaderProgram:
         status = gl.glGetProgramiv(self.handle, gl.GL_LINK_STATUS)
         if status:
             self.linked = True
+            self.reflect()
         else:
             raise RuntimeError("Link error: %s" % gl.glGetProgramInfoLog(self.handle))
 
+    def reflect(self):
+        #Enumerate active uniforms and attributes once so we never
+        #have to query locations by name while rendering.
+        self.uniforms = {}
+        self.attributes = {}
+        self.values = {}
+
+        for i in range(gl.glGetProgramiv(self.handle, gl.GL_ACTIVE_UNIFORMS)):
+            name, size, type = gl.glGetActiveUniform(self.handle, i)
+            name = stripArrayName(name)
+            location = gl.glGetUniformLocation(self.handle, name)
+            if location != -1:
+                info = UniformInfo(name, location, size, type)
+                info.initial = self.readUniform(info)
+                self.uniforms[name] = info
+
+        for i in range(gl.glGetProgramiv(self.handle, gl.GL_ACTIVE_ATTRIBUTES)):
+            name, size, type = gl.glGetActiveAttrib(self.handle, i)
+            location = gl.glGetAttribLocation(self.handle, name)
+            if location != -1:
+                self.attributes[name] = AttributeInfo(name, location, size, type)
+
+    def readUniform(self, info):
+        #Values right after linking, these include GLSL initializers
+        if info.type in FLOAT_TYPES:
+            count, getter, valueType = FLOAT_TYPES[info.type], gl.glGetUniformfv, gl.GLfloat
+        elif info.type in INT_TYPES:
+            count, getter, valueType = INT_TYPES[info.type], gl.glGetUniformiv, gl.GLint
+        elif info.type in SAMPLER_TYPES:
+            count, getter, valueType = 1, gl.glGetUniformiv, gl.GLint
+        elif info.type in MATRIX_TYPES:
+            count, getter, valueType = MATRIX_TYPES[info.type][0], gl.glGetUniformfv, gl.GLfloat
+        else:
+            return None
+
+        values = []
+        for i in range(info.size):
+            location = info.location
+            if i > 0:
+                location = gl.glGetUniformLocation(self.handle, "%s[%i]" % (info.name, i))
+            result = (valueType * count)()
+            getter(self.handle, location, result)
+            values.extend(result)
+        return tuple(values)
+
     def free(self):
         if self.handle:
             gl.glDeleteProgram(self.handle)
+            glstate.getState().forgetProgram(self.handle)
             self.handle = 0
         self.linked = False
+        self.uniforms = {}
+        self.attributes = {}
+        self.values = {}
 
     def bind(self):
-        gl.glUseProgram(self.handle)
+        glstate.getState().useProgram(self.handle)
 
     def unbind(self):
-        gl.glUseProgram(0)
+        glstate.getState().useProgram(0)
+
+    def getUniformLocation(self, name):
+        info = self.uniforms.get(name)
+        if info:
+            return info.location
+        return -1
+
+    def getAttribLocation(self, name):
+        info = self.attributes.get(name)
+        if info:
+            return info.location
+        return -1
+
+    def hasUniform(self, name):
+        return name in self.uniforms
+
+    def getUploadStats(self):
+        return {"issued": self.uploadsIssued, "skipped": self.uploadsSkipped}
+
+    def resetUploadStats(self):
+        self.uploadsIssued = 0
+        self.uploadsSkipped = 0
+
+    def _shouldUpload(self, name, values):
+        #Uniform values are stored in the program object, so if the last
+        #value we sent is still the same there is no need to send it again.
+        info = self.uniforms.get(name)
+        if not info:
+            #Inactive or optimized out, nothing to set
+            return None
+
+        if self.values.get(name) == values:
+            self.uploadsSkipped += 1
+            return None
+
+        self.values[name] = values
+        self.uploadsIssued += 1
+        return info
+
+    def setUniform(self, name, *values):
+        #Typed setter, uses the reflected type to choose the right call.
+        info = self.uniforms.get(name)
+        if not info:
+            return
+
+        if info.type in FLOAT_TYPES:
+            self.uniformf(name, *values)
+        elif info.type in INT_TYPES or info.type in SAMPLER_TYPES:
+            self.uniformi(name, *[int(v) for v in values])
+        elif info.type == gl.GL_FLOAT_MAT4:
+            if info.size > 1:
+                self.uniformMatrix4fArray(name, values[0])
+            else:
+                self.uniformMatrix4f(name, values[0])
+        else:
+            raise RuntimeError("Unsupported uniform type for '%s': %s" % (name, info.type))
+
+    def resetUniforms(self, names):
+        #Sets uniforms back to the values they had after linking
+        for name in names:
+            info = self.uniforms.get(name)
+            if not info or not name in self.values:
+                continue
+
+            if info.initial is None:
+                raise RuntimeError("Can't reset uniform '%s' of type %s" % (name, info.type))
+            self.uniformArray(name, info.initial)
+
+    def uniformArray(self, name, values):
+        #Any uniform or uniform array from a flat list of values, the
+        #upload call is chosen from the reflected type.
+        values = tuple(values)
+        info = self._shouldUpload(name, values)
+        if not info:
+            return
+
+        if info.type in FLOAT_TYPES:
+            components = FLOAT_TYPES[info.type]
+            data = (ctypes.c_float * len(values))(*values)
+            FLOAT_ARRAY_SETTERS[components](info.location, len(values) / components, data)
+        elif info.type in INT_TYPES or info.type in SAMPLER_TYPES:
+            components = INT_TYPES.get(info.type, 1)
+            data = (ctypes.c_int * len(values))(*[int(v) for v in values])
+            INT_ARRAY_SETTERS[components](info.location, len(values) / components, data)
+        elif info.type in MATRIX_TYPES:
+            components, setter = MATRIX_TYPES[info.type]
+            setter(info.location, len(values) / components, False, (ctypes.c_float * len(values))(*values))
+        else:
+            raise RuntimeError("Unsupported uniform type for '%s': %s" % (name, info.type))
 
     def uniformf(self, name, *values):
-        {1 : gl.glUniform1f,
-         2 : gl.glUniform2f,
-         3 : gl.glUniform3f,
-         4 : gl.glUniform4f
-        }[len(values)](gl.glGetUniformLocation(self.handle, name), *values)
+        info = self._shouldUpload(name, values)
+        if info:
+            {1 : gl.glUniform1f,
+             2 : gl.glUniform2f,
+             3 : gl.glUniform3f,
+             4 : gl.glUniform4f
+            }[len(values)](info.location, *values)
 
     def uniformi(self, name, *values):
-        {1 : gl.glUniform1i,
-         2 : gl.glUniform2i,
-         3 : gl.glUniform3i,
-         4 : gl.glUniform4i
-        }[len(values)](gl.glGetUniformLocation(self.handle, name), *values)
+        info = self._shouldUpload(name, values)
+        if info:
+            {1 : gl.glUniform1i,
+             2 : gl.glUniform2i,
+             3 : gl.glUniform3i,
+             4 : gl.glUniform4i
+            }[len(values)](info.location, *values)
 
     def uniformMatrix4f(self, name, matrix):
-        loc = gl.glGetUniformLocation(self.handle, name)
-        gl.glUniformMatrix4fv(loc, 1, False, (ctypes.c_float * 16)(*matrix))
+        matrix = tuple(matrix)
+        info = self._shouldUpload(name, matrix)
+        if info:
+            gl.glUniformMatrix4fv(info.location, 1, False, (ctypes.c_float * 16)(*matrix))
 
     def uniformMatrix4fArray(self, name, values):
-        loc = gl.glGetUniformLocation(self.handle, name)
-        count = len(values) / 16
-        gl.glUniformMatrix4fv(loc, count, False, (ctypes.c_float * len(values))(*values))
+        values = tuple(values)
+        info = self._shouldUpload(name, values)
+        if info:
+            count = len(values) / 16
+            gl.glUniformMatrix4fv(info.location, count, False, (ctypes.c_float * len(values))(*values))
+
+    def uniform4fArray(self, name, values):
+        values = tuple(values)
+        info = self._shouldUpload(name, values)
+        if info:
+            count = len(values) / 4
+            gl.glUniform4fv(info.location, count, (ctypes.c_float * len(values))(*values))
@@ -1,6 +1,7 @@
 
 import ctypes
 from OpenGL import GL as gl
+import glstate
 
 class Texture:
     def __init__(self, surface):
@@ -24,18 +25,19 @@ class Texture:
         BYTEP = ctypes.POINTER(ctypes.c_ubyte)
         ptr = ctypes.cast(surface._pixels_address, BYTEP)
 
+        state = glstate.getState()
         gl.glGenTextures(1, textureId)
-        gl.glEnable(gl.GL_TEXTURE_2D)
-        gl.glActiveTexture(gl.GL_TEXTURE0)
+        state.enable(gl.GL_TEXTURE_2D)
+        state.setActiveTexture(0)
 
         gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, surface.get_pitch() // surface.get_bytesize())
-        gl.glBindTexture(gl.GL_TEXTURE_2D, textureId[0])
+        state.bindTexture(0, textureId[0])
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, self.width, self.height, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ptr)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0);
+        state.bindTexture(0, 0)
         gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
 
         surface.unlock()
@@ -45,11 +47,11 @@ class Texture:
     def free(self):
         if self.textureId:
             gl.glDeleteTextures(1, self.textureId)
+            glstate.getState().forgetTexture(self.textureId)
             self.textureId = 0
 
     def valid(self):
         return self.textureId != 0
 
     def bind(self, index):
-        gl.glActiveTexture(gl.GL_TEXTURE0 + index)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.textureId)
+        glstate.getState().bindTexture(index, self.textureId)
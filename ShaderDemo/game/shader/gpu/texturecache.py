@@ -0,0 +1,112 @@
+
+from texture import Texture
+
+class TextureCacheEntry:
+    def __init__(self, key, texture, private):
+        self.key = key
+        self.texture = texture
+        self.private = private
+        self.refCount = 0
+        self.lastUsed = 0
+
+    def getByteSize(self):
+        return self.texture.width * self.texture.height * 4
+
+class TextureCache:
+    #Shares uploaded textures between users. Textures that are no longer
+    #referenced are kept around until the memory budget is exceeded, after
+    #which the least recently used ones are freed first.
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = {}
+        self.generation = None
+        self.useCounter = 0
+        self.privateCounter = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def checkGeneration(self, generation):
+        if generation != self.generation:
+            #OpenGL context has been reset, old handles are no longer valid
+            self.entries.clear()
+            self.generation = generation
+
+    def acquire(self, key, loader, generation):
+        #Key None means the texture can't be shared with anyone
+        self.checkGeneration(generation)
+
+        private = key is None
+        if private:
+            self.privateCounter += 1
+            key = ("private", self.privateCounter)
+
+        entry = self.entries.get(key)
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+            texture = Texture(loader())
+            if not texture.valid():
+                raise RuntimeError("Can't load gl texture: %s" % str(key))
+            entry = TextureCacheEntry(key, texture, private)
+            self.entries[key] = entry
+
+        self.useCounter += 1
+        entry.lastUsed = self.useCounter
+        entry.refCount += 1
+
+        self.evict()
+
+        return entry.texture
+
+    def release(self, texture):
+        for key, entry in self.entries.items():
+            if entry.texture is texture:
+                entry.refCount -= 1
+                if entry.refCount <= 0 and entry.private:
+                    self.remove(key)
+                break
+        #If not found, it belongs to an earlier generation
+
+        self.evict()
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        entry.texture.free()
+
+    def evict(self):
+        unused = [e for e in self.entries.values() if e.refCount <= 0]
+        unused.sort(key=lambda e: e.lastUsed)
+        total = self.getByteSize()
+        for entry in unused:
+            if total <= self.budget:
+                break
+            total -= entry.getByteSize()
+            self.remove(entry.key)
+            self.evictions += 1
+
+    def clear(self):
+        for entry in self.entries.values():
+            entry.texture.free()
+        self.entries.clear()
+
+    def getByteSize(self):
+        return sum([e.getByteSize() for e in self.entries.values()])
+
+    def getEntries(self):
+        #For debugging, (key, bytes, references) tuples, largest first
+        results = [(e.key, e.getByteSize(), e.refCount) for e in self.entries.values()]
+        results.sort(key=lambda r: -r[1])
+        return results
+
+    def getStats(self):
+        return {
+            "textures": len(self.entries),
+            "bytes": self.getByteSize(),
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,106 @@
+
+import math
+import gpu
+import shadercode
+
+#Tiled lights for PS_DEFERRED. The screen is split into tiles and every
+#light is added to the tiles its radius can reach, so a pixel only evaluates
+#the lights of its own tile. Lights use the same fields as the "lights"
+#uniform: position (a, b, c), color (e, f, g) and distance (i), negative
+#distance meaning no falloff.
+
+TILE_TEXELS = 8
+TILE_LIGHTS = TILE_TEXELS * 4
+LIGHT_COLUMNS = 2
+
+def getDefines():
+    return {"TILED_LIGHTS": 1, "TILE_TEXELS": TILE_TEXELS}
+
+def getLightParams(matrix):
+    return (matrix.a, matrix.b, matrix.c), (matrix.e, matrix.f, matrix.g), matrix.i
+
+def getLightBounds(position, distance, aspect):
+    #Rectangle in texture coordinates where the light can have an effect, None is everywhere.
+    #The shader scales x by the aspect ratio and maps coordinates to -1.0 - 1.0.
+    if distance < 0.0:
+        return None
+    radiusX = distance / (2.0 * aspect)
+    radiusY = distance / 2.0
+    return (position[0] - radiusX, position[1] - radiusY, position[0] + radiusX, position[1] + radiusY)
+
+def getTileRange(start, end, count):
+    first = min(max(int(math.floor(start * count)), 0), count - 1)
+    last = min(max(int(math.floor(end * count)), 0), count - 1)
+    return range(first, last + 1)
+
+class TiledLights:
+    def __init__(self, tileSize):
+        self.tileSize = tileSize
+        self.lightTexture = gpu.DataTexture(LIGHT_COLUMNS, 0)
+        self.tileTexture = gpu.DataTexture(TILE_TEXELS, 0)
+        self.tileCount = (1, 1)
+        self.lightCount = 0
+        self.dropped = 0
+
+    def free(self):
+        self.lightTexture.free()
+        self.tileTexture.free()
+
+    def getTileCount(self, width, height):
+        return max(int(math.ceil(width / float(self.tileSize))), 1), max(int(math.ceil(height / float(self.tileSize))), 1)
+
+    def binLights(self, lights, width, height):
+        columns, rows = self.getTileCount(width, height)
+        aspect = width / float(height)
+        tiles = [[] for i in range(columns * rows)]
+
+        lightRows = []
+        for index, matrix in enumerate(lights[-shadercode.DEFERRED_MAX_TILED_LIGHTS:]):
+            position, color, distance = getLightParams(matrix)
+            lightRows.append((position[0], position[1], position[2], distance, color[0], color[1], color[2], 0.0))
+
+            bounds = getLightBounds(position, distance, aspect)
+            if bounds:
+                for y in getTileRange(bounds[1], bounds[3], rows):
+                    for x in getTileRange(bounds[0], bounds[2], columns):
+                        tiles[y * columns + x].append(index)
+            else:
+                for tile in tiles:
+                    tile.append(index)
+
+        tileRows = []
+        for tile in tiles:
+            if len(tile) > TILE_LIGHTS:
+                #Like the untiled version, later lights win
+                self.dropped += len(tile) - TILE_LIGHTS
+                tile = tile[-TILE_LIGHTS:]
+            tileRows.append(tuple(tile) + (-1.0,) * (TILE_LIGHTS - len(tile)))
+
+        self.tileCount = (columns, rows)
+        self.lightCount = len(lightRows)
+        return lightRows, tileRows
+
+    def upload(self, program, lights, width, height, firstUnit):
+        lightRows, tileRows = self.binLights(lights, width, height)
+
+        self.lightTexture.unit = firstUnit
+        self.tileTexture.unit = firstUnit + 1
+        self.lightTexture.update(lightRows or [(0.0,) * (LIGHT_COLUMNS * 4)])
+        self.tileTexture.update(tileRows)
+        self.lightTexture.bind()
+        self.tileTexture.bind()
+
+        program.uniformi("lightData", self.lightTexture.unit)
+        program.uniformi("lightTiles", self.tileTexture.unit)
+        program.uniformf("lightDataRows", float(self.lightTexture.rows))
+        program.uniformf("lightTileRows", float(self.tileTexture.rows))
+        program.uniformf("lightTileCount", float(self.tileCount[0]), float(self.tileCount[1]))
+
+    def getStats(self):
+        return {
+            "lights": self.lightCount,
+            "tiles": self.tileCount[0] * self.tileCount[1],
+            "dropped": self.dropped,
+            "lightRowsUploaded": self.lightTexture.rowsUploaded,
+            "tileRowsUploaded": self.tileTexture.rowsUploaded,
+        }
@@ -50,6 +50,7 @@ class MeshObj(object):
         self.vertices = None
         self.normals = None
         self.uvs = None
+        self.version = 0
 
     def load(self):
         if self.vertices:
@@ -59,4 +60,5 @@ class MeshObj(object):
         self.vertices = utils.makeFloatArray(verts, 3)
         self.normals = utils.makeFloatArray(normals, 3)
         self.uvs = utils.makeFloatArray(uvs, 2)
+        self.version += 1
 
@@ -0,0 +1,187 @@
+
+import time
+import ctypes
+import collections
+import renpy
+from OpenGL import GL as gl
+
+def isGpuTimerSupported():
+    try:
+        return bool(gl.glGenQueries) and bool(gl.glQueryCounter)
+    except AttributeError:
+        return False
+
+def getQueryValue(query, name, type):
+    value = type(0)
+    {gl.GLint: gl.glGetQueryObjectiv, gl.GLuint64: gl.glGetQueryObjectui64v}[type](query, name, ctypes.byref(value))
+    return value.value
+
+def percentile(values, percent):
+    #Nearest rank, values must be sorted
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+class NullScope:
+    #Used when profiling is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+NULL_SCOPE = NullScope()
+
+class Scope:
+    def __init__(self, profiler, name, gpu):
+        self.profiler = profiler
+        self.name = name
+        self.gpu = gpu
+        self.start = 0
+        self.queries = None
+
+    def __enter__(self):
+        if self.gpu:
+            self.queries = self.profiler.beginGpuTimer()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        cpu = time.time() - self.start
+        if self.queries:
+            self.profiler.endGpuTimer(self.name, self.queries)
+        self.profiler.addSample(self.name, "cpu", cpu)
+        return False
+
+class PhaseHistory:
+    def __init__(self, size):
+        self.cpu = collections.deque(maxlen=size)
+        self.gpu = collections.deque(maxlen=size)
+
+    def getSamples(self, kind):
+        return self.cpu if kind == "cpu" else self.gpu
+
+class Profiler:
+    #Named scoped timers with a rolling history per phase. GPU time is
+    #measured with timestamp queries when the driver has them, results
+    #are collected later so we never wait for the GPU.
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, historySize=300):
+        self.historySize = historySize
+        self.phases = collections.OrderedDict()
+        self.freeQueries = []
+        self.pendingQueries = []
+        self.gpuSupported = None
+
+    def scope(self, name, gpu=False):
+        return Scope(self, name, gpu)
+
+    def addSample(self, name, kind, seconds):
+        history = self.phases.get(name)
+        if not history:
+            history = PhaseHistory(self.historySize)
+            self.phases[name] = history
+        history.getSamples(kind).append(seconds * 1000.0)
+
+    def beginGpuTimer(self):
+        if self.gpuSupported is None:
+            self.gpuSupported = isGpuTimerSupported()
+        if not self.gpuSupported:
+            return None
+
+        if len(self.freeQueries) < 2:
+            queries = (gl.GLuint * 8)()
+            gl.glGenQueries(8, queries)
+            self.freeQueries.extend(queries)
+
+        queries = (self.freeQueries.pop(), self.freeQueries.pop())
+        gl.glQueryCounter(queries[0], gl.GL_TIMESTAMP)
+        return queries
+
+    def endGpuTimer(self, name, queries):
+        gl.glQueryCounter(queries[1], gl.GL_TIMESTAMP)
+        self.pendingQueries.append((name, queries))
+
+    def collectGpuTimers(self):
+        #Reads results that are ready, in order
+        while self.pendingQueries:
+            name, queries = self.pendingQueries[0]
+            if not getQueryValue(queries[1], gl.GL_QUERY_RESULT_AVAILABLE, gl.GLint):
+                break
+
+            start = getQueryValue(queries[0], gl.GL_QUERY_RESULT, gl.GLuint64)
+            end = getQueryValue(queries[1], gl.GL_QUERY_RESULT, gl.GLuint64)
+            self.addSample(name, "gpu", (end - start) / 1000000000.0)
+
+            self.pendingQueries.pop(0)
+            self.freeQueries.extend(queries)
+
+    def endFrame(self):
+        if self.pendingQueries:
+            self.collectGpuTimers()
+
+    def resetQueries(self):
+        #OpenGL context has been reset, old query names are no longer valid
+        self.freeQueries = []
+        self.pendingQueries = []
+        self.gpuSupported = None
+
+    def reset(self):
+        self.phases.clear()
+        self.resetQueries()
+
+    def getPercentiles(self, name, kind="cpu"):
+        history = self.phases.get(name)
+        if not history:
+            return None
+
+        values = sorted(history.getSamples(kind))
+        if not values:
+            return None
+        return [percentile(values, p) for p in self.PERCENTILES]
+
+    def getSummary(self):
+        #(name, samples, cpu percentiles, gpu percentiles) tuples
+        results = []
+        for name, history in self.phases.items():
+            results.append((name, len(history.cpu), self.getPercentiles(name, "cpu"), self.getPercentiles(name, "gpu")))
+        return results
+
+    def exportCsv(self, path):
+        columns = ["phase", "samples"]
+        for kind in ("cpu", "gpu"):
+            for p in self.PERCENTILES:
+                columns.append("%s_p%i_ms" % (kind, p))
+
+        with open(path, "w") as f:
+            f.write(",".join(columns) + "\n")
+            for name, count, cpu, gpu in self.getSummary():
+                values = [name, str(count)]
+                for times in (cpu, gpu):
+                    for value in (times or [None] * len(self.PERCENTILES)):
+                        values.append("" if value is None else "%.4f" % value)
+                f.write(",".join(values) + "\n")
+
+    def drawOverlay(self, context):
+        #Bars show the median, the thin line the 90th percentile. One pixel is 0.1 ms.
+        context.createOverlayCanvas()
+        canvas = context.overlayCanvas
+
+        y = 4
+        for name, count, cpu, gpu in self.getSummary():
+            label = "%s %.2f/%.2f ms" % (name, cpu[0], cpu[1]) if cpu else name
+            if gpu:
+                label += " gpu %.2f" % gpu[0]
+
+            if cpu:
+                canvas.rect("#0f08", (4, y, max(int(cpu[0] * 10), 1), 6))
+                canvas.line("#ff0", (4 + int(cpu[1] * 10), y), (4 + int(cpu[1] * 10), y + 6))
+            if gpu:
+                canvas.rect("#08f8", (4, y + 7, max(int(gpu[0] * 10), 1), 3))
+
+            text = renpy.display.render.render(renpy.text.text.Text(label, size=12), context.width, context.height, 0, 0)
+            context.overlayRender.blit(text, (8, y + 10))
+            y += 30
@@ -0,0 +1,89 @@
+
+import renpy
+from OpenGL import GL as gl
+import profiler
+
+#Quality tiers for PS_DEFERRED, from the cheapest to the best looking. The
+#features are compiled in or out with defines, so a lower tier doesn't pay
+#for effects that the uniforms would have disabled anyway. "high" is what
+#the shader does without any tier.
+
+AUTO = "auto"
+
+TIERS = [
+    ("low", {"SHADOW_SAMPLES": 0, "SHADOW_STEPS": 0, "SHADOW_TRACE_STEPS": 0, "FOG": 0, "FOG_RAIN": 0, "DEPTH_OF_FIELD": 0}),
+    ("medium", {"SHADOW_SAMPLES": 1, "SHADOW_STEPS": 6, "SHADOW_TRACE_STEPS": 12, "FOG": 1, "FOG_RAIN": 0, "DEPTH_OF_FIELD": 0}),
+    ("high", {"SHADOW_SAMPLES": 4, "SHADOW_STEPS": 10, "SHADOW_TRACE_STEPS": 24, "FOG": 1, "FOG_RAIN": 1, "DEPTH_OF_FIELD": 1}),
+    ("ultra", {"SHADOW_SAMPLES": 4, "SHADOW_STEPS": 20, "SHADOW_TRACE_STEPS": 48, "FOG": 1, "FOG_RAIN": 1, "DEPTH_OF_FIELD": 1}),
+]
+
+def getTierNames():
+    return [name for name, defines in TIERS]
+
+def getTierIndex(name):
+    names = getTierNames()
+    if name not in names:
+        raise RuntimeError("Unknown quality tier: %s" % name)
+    return names.index(name)
+
+def getDefines(tier):
+    defines = dict(TIERS[tier][1])
+    defines["DEFERRED_QUALITY"] = tier
+    return defines
+
+def getMachineKey(width, height):
+    #Same hardware and driver can reuse the result, image size changes the cost a lot
+    return "%s %s %ix%i" % (gl.glGetString(gl.GL_RENDERER), gl.glGetString(gl.GL_VERSION), width, height)
+
+def loadTier(key, budget):
+    saved = renpy.store.persistent.shader_deferred_quality or {}
+    entry = saved.get(key)
+    if entry and entry[1] == budget and entry[0] in getTierNames():
+        return getTierIndex(entry[0])
+    return None
+
+def saveTier(key, budget, tier):
+    #Assign a new dict so Ren'Py sees the change
+    saved = dict(renpy.store.persistent.shader_deferred_quality or {})
+    saved[key] = (TIERS[tier][0], budget)
+    renpy.store.persistent.shader_deferred_quality = saved
+
+def clearSavedTiers():
+    renpy.store.persistent.shader_deferred_quality = None
+
+class QualityTuner:
+    #Measures the tiers from the best one down, a warm-up window of frames
+    #each, and settles on the first one whose median frame time fits the
+    #budget. The result is kept in persistent, so this only happens once
+    #per machine and image size.
+
+    def __init__(self, key, budget, warmup):
+        self.key = key
+        self.budget = budget
+        self.warmup = max(warmup, 4)
+        self.samples = []
+        self.tier = loadTier(key, budget)
+        self.settled = self.tier is not None
+        if not self.settled:
+            self.tier = len(TIERS) - 1
+
+    def addSample(self, seconds):
+        #Returns True if the tier changed
+        if self.settled:
+            return False
+
+        self.samples.append(seconds)
+        if len(self.samples) < self.warmup:
+            return False
+
+        #First frames of a tier include compiling the shader and texture uploads
+        samples = sorted(self.samples[self.warmup // 4:])
+        self.samples = []
+
+        if profiler.percentile(samples, 50) > self.budget and self.tier > 0:
+            self.tier -= 1
+            return True
+
+        self.settled = True
+        saveTier(self.key, self.budget, self.tier)
+        return False
@@ -14,25 +14,37 @@ import shadercode
 import mesh
 import utils
 import skin
+import skinnedmesh
 import gpu
+import atlas
+import bonedata
+import lighting
+import depthpyramid
+import quality
 
 class TextureEntry:
-    def __init__(self, image, sampler):
+    def __init__(self, image, sampler, key=None, loader=None):
+        #Surfaces can only be shared if the caller gives them a key
         self.sampler = sampler
 
-        if isinstance(image, (pygame.Surface)):
+        if loader:
             self.image = None
-            surface = image
+        elif isinstance(image, (pygame.Surface)):
+            self.image = None
+            loader = lambda: image
         else:
             self.image = image
-            surface = renpy.display.im.load_surface(self.image)
+            loader = lambda: renpy.display.im.load_surface(self.image)
+            if key is None:
+                key = shader.getImageKey(image)
 
-        self.texture = gpu.Texture(surface)
-        if not self.texture.valid():
-            raise RuntimeError("Can't load gl texture from image: %s" % image)
+        self.key = key
+        self.texture = shader.acquireTexture(key, loader)
 
     def free(self):
-        self.texture.free()
+        if self.texture:
+            shader.releaseTexture(self.texture)
+            self.texture = None
 
 class TextureMap:
     def __init__(self):
@@ -43,34 +55,78 @@ class TextureMap:
             entry.free()
         self.textures.clear()
 
-    def setTexture(self, sampler, image):
-        entry = TextureEntry(image, sampler)
+    def setTexture(self, sampler, image, key=None):
+        self.setEntry(sampler, TextureEntry(image, sampler, key))
+
+    def setTextureLoader(self, sampler, key, loader):
+        #Loader is only called if the texture is not already cached
+        self.setEntry(sampler, TextureEntry(None, sampler, key, loader))
+
+    def setEntry(self, sampler, entry):
         old = self.textures.get(sampler)
         if old:
             old.free()
         self.textures[sampler] = entry
 
+    def getInputKey(self):
+        return tuple(sorted([(sampler, entry.texture) for sampler, entry in self.textures.items()]))
+
+    def getCacheKey(self):
+        keys = []
+        for sampler, entry in sorted(self.textures.items()):
+            if entry.key is None:
+                #Private texture, no way to tell if it is the same next time
+                return None
+            keys.append((sampler, entry.key))
+        return tuple(keys)
+
     def bindTextures(self, shader):
+        #Texture units are reset once at the end of the frame
         index = 0
         for sampler, entry in self.textures.items():
             shader.uniformi(sampler, index)
-            gl.glActiveTexture(gl.GL_TEXTURE0 + index)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, entry.texture.textureId)
+            entry.texture.bind(index)
             index += 1
 
-    def unbindTextures(self):
-        for i in range(len(self.textures)):
-            gl.glActiveTexture(gl.GL_TEXTURE0 + i)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-
 
 class BaseRenderer(object):
     def __init__(self):
         self.useDepth = False
         self.clearColor = (0, 0, 0, 0)
+        self.geometries = {}
+
+    def bindShader(self, context):
+        self.shader.bind()
+        #Programs are shared between renderers, so clear any values
+        #that some other user has set but we are not going to set.
+        self.shader.resetUniforms(self.shader.userUniforms.difference(context.uniforms))
+
+    def isTimeDependent(self):
+        for name in ("shownTime", "animationTime"):
+            if self.shader.hasUniform(name):
+                return True
+        return False
+
+    def getStateKey(self):
+        #Fields common to all renderers that change the image, these can be
+        #set at any time, like from an update callback.
+        return (tuple(self.clearColor), self.useDepth)
+
+    def getInputKey(self):
+        #Renderer state that affects the image but is not in the uniforms
+        return None
+
+    def getCacheKey(self):
+        #Like getInputKey, but must stay the same between controller resets.
+        #None means the output can't be cached.
+        return None
+
+    def updateQuality(self, seconds):
+        #Called with the render and readback time of every rendered frame
+        pass
 
     def setUniforms(self, shader, uniforms):
+        shader.userUniforms = set(uniforms)
         for key, value in uniforms.items():
             if isinstance(value, (int, float)):
                 shader.uniformf(key, value)
@@ -91,16 +147,37 @@ class BaseRenderer(object):
                 raise RuntimeError("Unknown uniform type: %s" % type(value))
 
     def bindAttributeArray(self, shader, name, data, count):
-        location = gl.glGetAttribLocation(shader.handle, name)
+        location = shader.getAttribLocation(name)
         if location != -1:
             gl.glVertexAttribPointer(location, count, gl.GL_FLOAT, False, 0, data)
             gl.glEnableVertexAttribArray(location)
 
     def unbindAttributeArray(self, shader, name):
-        location = gl.glGetAttribLocation(shader.handle, name)
+        location = shader.getAttribLocation(name)
         if location != -1:
             gl.glDisableVertexAttribArray(location)
 
+    def useBufferObjects(self):
+        return shader.config.useBufferObjects and gpu.isBufferSupported()
+
+    def getGeometry(self, key, mesh, attributes, indices=None):
+        #Returns GPU buffers for the mesh, uploading them only if the mesh has changed.
+        geometry = self.geometries.get(key)
+        if geometry and geometry.isCurrent(mesh, mesh.version):
+            return geometry
+
+        if not geometry:
+            geometry = gpu.GeometryBuffer()
+            self.geometries[key] = geometry
+
+        geometry.upload(mesh, mesh.version, attributes, indices)
+        return geometry
+
+    def freeGeometries(self):
+        for key, geometry in self.geometries.items():
+            geometry.free()
+        self.geometries.clear()
+
     def setTexture(self, sampler, image):
         raise NotImplementedError("Must be implemented")
 
@@ -120,28 +197,111 @@ class Renderer2D(BaseRenderer):
         self.shader = None
         self.verts = self.createVertexQuad()
         self.textureMap = TextureMap()
+        self.blur = None
+        self.tiledLights = None
+        self.depthPyramid = False
+        self.lightLimit = None
+        self.quality = None
+        self.qualityTuner = None
+        self.shaderSources = None
+        self.defines = {}
+
+    def init(self, image, vertexShader, pixeShader, args=None):
+        args = args or {}
+        self.textureMap.setTexture(shader.TEX0, image)
 
-    def init(self, image, vertexShader, pixeShader):
-        self.shader = gpu.ShaderProgram(vertexShader, pixeShader)
+        if pixeShader == shader.PS_DEFERRED:
+            self.lightLimit = shadercode.DEFERRED_MAX_LIGHTS
+            if isTiledLightingEnabled(args):
+                self.tiledLights = lighting.TiledLights(shader.config.deferredTileSize)
+                self.defines.update(lighting.getDefines())
+                self.lightLimit = shadercode.DEFERRED_MAX_TILED_LIGHTS
+            if args.get("depthPyramid", shader.config.depthPyramid) and depthpyramid.isSupported():
+                self.depthPyramid = True
+                self.defines["DEPTH_PYRAMID"] = 1
+            self.initQuality(args.get("quality", shader.config.deferredQuality))
+            self.defines.update(quality.getDefines(self.quality))
 
-        self.textureMap.setTexture(shader.TEX0, image)
+        self.shaderSources = (vertexShader, pixeShader)
+        self.shader = shader.acquireProgram(vertexShader, pixeShader, self.defines or None)
+
+        if pixeShader == shader.PS_BLUR_2D and args.get("multiPassBlur", shader.config.multiPassBlur):
+            self.blur = MultiPassBlur()
 
     def setTexture(self, sampler, image):
         self.textureMap.setTexture(sampler, image)
 
+        if sampler == "depthMap" and self.depthPyramid:
+            #Built once per depth image, the texture cache shares it after that
+            def loader():
+                if isinstance(image, pygame.Surface):
+                    return depthpyramid.createPyramidSurface(image)
+                return depthpyramid.createPyramidSurface(renpy.display.im.load_surface(image))
+
+            key = shader.getImageKey(image)
+            self.textureMap.setTextureLoader(depthpyramid.SAMPLER, key and ("depthPyramid", key), loader)
+
     def free(self):
         if self.textureMap:
             self.textureMap.free()
             self.textureMap = None
 
+        if self.blur:
+            self.blur.free()
+            self.blur = None
+
+        if self.tiledLights:
+            self.tiledLights.free()
+            self.tiledLights = None
+
         if self.shader:
-            self.shader.free()
+            shader.releaseProgram(self.shader)
             self.shader = None
 
     def getSize(self):
         entry = self.textureMap.textures[shader.TEX0]
         return entry.texture.width, entry.texture.height
 
+    def setDepthPyramidUniforms(self):
+        textures = self.textureMap.textures
+        if depthpyramid.SAMPLER in textures:
+            uniforms = depthpyramid.getUniforms(textures["depthMap"].texture, textures[depthpyramid.SAMPLER].texture)
+            for name, values in uniforms.items():
+                self.shader.uniformf(name, *values)
+        else:
+            #Falls back to the plain shadow march
+            self.shader.uniformf("depthPyramidLevels", 0.0)
+
+    def initQuality(self, name):
+        if name == quality.AUTO:
+            width, height = self.getSize()
+            self.qualityTuner = quality.QualityTuner(quality.getMachineKey(width, height),
+                shader.config.deferredQualityBudget, shader.config.deferredQualityWarmup)
+            self.quality = self.qualityTuner.tier
+        else:
+            self.quality = quality.getTierIndex(name)
+
+    def updateQuality(self, seconds):
+        if self.qualityTuner and self.qualityTuner.addSample(seconds):
+            self.setQuality(self.qualityTuner.tier)
+
+    def setQuality(self, tier):
+        self.quality = tier
+        self.defines.update(quality.getDefines(tier))
+
+        old = self.shader
+        self.shader = shader.acquireProgram(self.shaderSources[0], self.shaderSources[1], self.defines)
+        shader.releaseProgram(old)
+
+    def getInputKey(self):
+        return (self.textureMap.getInputKey(), self.quality)
+
+    def getCacheKey(self):
+        key = self.textureMap.getCacheKey()
+        if key is None:
+            return None
+        return (key, self.quality)
+
     def createVertexQuad(self):
         tx2 = 1.0 #Adjust if rounding textures to power of two
         ty2 = 1.0
@@ -153,28 +313,156 @@ class Renderer2D(BaseRenderer):
         ]
         return (gl.GLfloat * len(vertices))(*vertices)
 
+    def getProjection(self):
+        flipY = -1
+        return utils.createPerspectiveOrtho(-1.0, 1.0, 1.0 * flipY, -1.0 * flipY, -1.0, 1.0)
+
+    def drawQuad(self, program):
+        self.bindAttributeArray(program, "inVertex", self.verts, 4)
+        gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, len(self.verts) // 4);
+        self.unbindAttributeArray(program, "inVertex")
+
     def render(self, context):
-        self.shader.bind()
+        if self.blur and self.blur.isUsed(self, context):
+            with shader.profile("draw", True):
+                self.blur.render(self, context)
+            return
 
-        flipY = -1
-        projection = utils.createPerspectiveOrtho(-1.0, 1.0, 1.0 * flipY, -1.0 * flipY, -1.0, 1.0)
-        self.shader.uniformMatrix4f(shader.PROJECTION, projection)
-        self.shader.uniformf("imageSize", *self.getSize())
+        self.bindShader(context)
 
-        self.setUniforms(self.shader, context.uniforms)
+        self.shader.uniformMatrix4f(shader.PROJECTION, self.getProjection())
+        self.shader.uniformf("imageSize", *self.getSize())
+        if self.depthPyramid:
+            self.setDepthPyramidUniforms()
+
+        with shader.profile("uniforms"):
+            uniforms = context.uniforms
+            if self.tiledLights:
+                #Lights go into textures instead of uniforms
+                uniforms = dict(uniforms)
+                lights = uniforms.pop("lights", [])
+                uniforms.pop("lightCount", None)
+                width, height = self.getSize()
+                self.tiledLights.upload(self.shader, lights, width, height, len(self.textureMap.textures))
+            elif self.lightLimit and len(uniforms.get("lights", [])) > self.lightLimit:
+                #Keep the last lights like getDeferredLightLimit() users do
+                uniforms = dict(uniforms)
+                uniforms["lights"] = uniforms["lights"][-self.lightLimit:]
+                uniforms["lightCount"] = min(uniforms.get("lightCount", 0), self.lightLimit)
+            self.setUniforms(self.shader, uniforms)
 
         self.textureMap.bindTextures(self.shader)
 
         gl.glClearColor(*self.clearColor)
         gl.glClear(gl.GL_COLOR_BUFFER_BIT)
 
-        self.bindAttributeArray(self.shader, "inVertex", self.verts, 4)
-        gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, len(self.verts) // 4);
-        self.unbindAttributeArray(self.shader, "inVertex")
+        with shader.profile("draw", True):
+            self.drawQuad(self.shader)
+
+def isTiledLightingEnabled(args=None):
+    enabled = (args or {}).get("tiledLights", shader.config.tiledLights)
+    return enabled and gpu.isFloatTextureSupported()
+
+class MultiPassBlur:
+    #Separable version of PS_BLUR_2D. The image is halved until one blur step
+    #is about a texel, blurred horizontally and vertically between
+    #two pooled render targets and stretched back up. Cost grows with the image
+    #area instead of the blur size. Small blurs use the same passes at full
+    #resolution, so an animated blur size doesn't switch between kernels.
 
-        self.textureMap.unbindTextures()
+    MAX_STEP = 1.0
 
-        self.shader.unbind()
+    def __init__(self):
+        self.copyShader = shader.acquireProgram(shader.VS_2D, shader.PS_COPY_2D)
+        self.passShader = shader.acquireProgram(shader.VS_2D, shader.PS_BLUR_PASS_2D)
+
+    def free(self):
+        shader.releaseProgram(self.copyShader)
+        shader.releaseProgram(self.passShader)
+        self.copyShader = None
+        self.passShader = None
+
+    def getBlurSize(self, context):
+        return abs(float(context.uniforms.get("blurSize", 0.0)))
+
+    def getScales(self, renderer, context):
+        #Halve until one blur step is small enough, a level at a time so no texels are skipped
+        blurSize = self.getBlurSize(context)
+        targetWidth = context.frameBuffer.width
+        imageWidth = renderer.getSize()[0]
+
+        scales = []
+        scale = 1.0
+        while blurSize * scale * targetWidth / float(imageWidth) > self.MAX_STEP and scale / 2.0 >= shader.config.blurMinScale:
+            scale /= 2.0
+            scales.append(scale)
+        return scales
+
+    def isUsed(self, renderer, context):
+        #Without a blur both versions just copy the image
+        return context.frameBuffer is not None and self.getBlurSize(context) > 0.0
+
+    def acquireFrameBuffer(self, width, height):
+        frameBuffer = shader.acquireFrameBuffer(width, height, False)
+        frameBuffer.setFilter(gl.GL_LINEAR)
+        return frameBuffer
+
+    def releaseFrameBuffer(self, frameBuffer):
+        #Pooled targets are shared, put back the filtering others expect
+        frameBuffer.setFilter(gl.GL_NEAREST)
+        shader.releaseFrameBuffer(frameBuffer)
+
+    def draw(self, renderer, program, frameBuffer, texture, projection, direction=None):
+        frameBuffer.bind()
+        gl.glViewport(0, 0, frameBuffer.width, frameBuffer.height)
+        gl.glClearColor(*renderer.clearColor)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+
+        program.bind()
+        program.uniformMatrix4f(shader.PROJECTION, projection)
+        program.uniformi(shader.TEX0, 0)
+        gpu.getState().bindTexture(0, texture)
+        if direction:
+            program.uniformf("imageSize", frameBuffer.width, frameBuffer.height)
+            program.uniformf("blurDirection", *direction)
+        renderer.drawQuad(program)
+
+    def render(self, renderer, context):
+        target = context.frameBuffer
+        imageWidth, imageHeight = renderer.getSize()
+        blurSize = self.getBlurSize(context)
+        identity = utils.matrixToList(euclid.Matrix4())
+
+        state = gpu.getState()
+        state.disable(gl.GL_BLEND)
+
+        texture = renderer.textureMap.textures[shader.TEX0].texture.textureId
+        source = None
+        width, height = target.width, target.height
+        for scale in self.getScales(renderer, context):
+            width, height = max(int(target.width * scale), 1), max(int(target.height * scale), 1)
+            frameBuffer = self.acquireFrameBuffer(width, height)
+            self.draw(renderer, self.copyShader, frameBuffer, texture, identity)
+            if source:
+                self.releaseFrameBuffer(source)
+            source = frameBuffer
+            texture = source.texture
+
+        #Horizontal and vertical passes, blur size is in image pixels
+        other = self.acquireFrameBuffer(width, height)
+        self.draw(renderer, self.passShader, other, texture, identity,
+            (blurSize * width / float(imageWidth), 0.0))
+        if not source:
+            #No downsampling, blur at full resolution
+            source = self.acquireFrameBuffer(width, height)
+        self.draw(renderer, self.passShader, source, other.texture, identity,
+            (0.0, blurSize * height / float(imageHeight)))
+        self.releaseFrameBuffer(other)
+
+        #Upsample into the real target, blended like the single pass version
+        state.enable(gl.GL_BLEND)
+        self.draw(renderer, self.copyShader, target, source.texture, renderer.getProjection())
+        self.releaseFrameBuffer(source)
 
 
 def createDefaultMatrices(width, height, context):
@@ -207,7 +495,7 @@ class Renderer3D(BaseRenderer):
     def init(self, vertexShader, pixelShader, width, height):
         self.width = width
         self.height = height
-        self.shader = gpu.ShaderProgram(vertexShader, pixelShader)
+        self.shader = shader.acquireProgram(vertexShader, pixelShader)
 
     def setTexture(self, sampler, image):
         self.models.itervalues().next().textureMap.setTexture(sampler, image)
@@ -217,6 +505,12 @@ class Renderer3D(BaseRenderer):
             entry.free()
         self.models.clear()
 
+        self.freeGeometries()
+
+        if self.shader:
+            shader.releaseProgram(self.shader)
+            self.shader = None
+
     def getModel(self, tag):
         return self.models.get(tag)
 
@@ -241,11 +535,27 @@ class Renderer3D(BaseRenderer):
     def getSize(self):
         return self.width, self.height
 
+    def getInputKey(self):
+        key = []
+        for tag, entry in sorted(self.models.items()):
+            key.append((tag, entry.mesh, entry.mesh.version, tuple(utils.matrixToList(entry.matrix)), entry.textureMap.getInputKey()))
+        return tuple(key)
+
+    def getCacheKey(self):
+        key = []
+        for tag, entry in sorted(self.models.items()):
+            textures = entry.textureMap.getCacheKey()
+            if textures is None:
+                return None
+            key.append((tag, entry.mesh.path, tuple(utils.matrixToList(entry.matrix)), textures))
+        return tuple(key)
+
     def render(self, context):
-        self.shader.bind()
+        self.bindShader(context)
 
-        gl.glDisable(gl.GL_BLEND)
-        gl.glEnable(gl.GL_DEPTH_TEST)
+        state = gpu.getState()
+        state.disable(gl.GL_BLEND)
+        state.enable(gl.GL_DEPTH_TEST)
 
         gl.glClearDepth(1.0)
         gl.glClearColor(*self.clearColor)
@@ -255,29 +565,34 @@ class Renderer3D(BaseRenderer):
         self.shader.uniformMatrix4f(shader.VIEW_MATRIX, view)
         self.shader.uniformMatrix4f(shader.PROJ_MATRIX, projection)
 
-        self.setUniforms(self.shader, context.uniforms)
-
-        for tag, entry in self.models.items():
-            mesh = entry.mesh
-
-            entry.textureMap.bindTextures(self.shader)
-
-            self.shader.uniformMatrix4f(shader.WORLD_MATRIX, entry.matrix)
-
-            self.bindAttributeArray(self.shader, "inPosition", mesh.vertices, 3)
-            self.bindAttributeArray(self.shader, "inNormal", mesh.normals, 3)
-            self.bindAttributeArray(self.shader, "inUv", mesh.uvs, 2)
-            gl.glDrawArrays(gl.GL_TRIANGLES, 0, len(mesh.vertices) // 3)
-            self.unbindAttributeArray(self.shader, "inPosition")
-            self.unbindAttributeArray(self.shader, "inNormal")
-            self.unbindAttributeArray(self.shader, "inUv")
-
-            entry.textureMap.unbindTextures()
-
-        gl.glEnable(gl.GL_BLEND)
-        gl.glDisable(gl.GL_DEPTH_TEST)
-
-        self.shader.unbind()
+        with shader.profile("uniforms"):
+            self.setUniforms(self.shader, context.uniforms)
+
+        with shader.profile("draw", True):
+            for tag, entry in self.models.items():
+                mesh = entry.mesh
+
+                entry.textureMap.bindTextures(self.shader)
+
+                self.shader.uniformMatrix4f(shader.WORLD_MATRIX, entry.matrix)
+
+                if self.useBufferObjects():
+                    geometry = self.getGeometry(tag, mesh, [
+                        ("inPosition", mesh.vertices, 3),
+                        ("inNormal", mesh.normals, 3),
+                        ("inUv", mesh.uvs, 2),
+                    ])
+                    geometry.bind(self.shader)
+                    geometry.drawArrays(gl.GL_TRIANGLES, len(mesh.vertices) // 3)
+                    geometry.unbind(self.shader)
+                else:
+                    self.bindAttributeArray(self.shader, "inPosition", mesh.vertices, 3)
+                    self.bindAttributeArray(self.shader, "inNormal", mesh.normals, 3)
+                    self.bindAttributeArray(self.shader, "inUv", mesh.uvs, 2)
+                    gl.glDrawArrays(gl.GL_TRIANGLES, 0, len(mesh.vertices) // 3)
+                    self.unbindAttributeArray(self.shader, "inPosition")
+                    self.unbindAttributeArray(self.shader, "inNormal")
+                    self.unbindAttributeArray(self.shader, "inUv")
 
 class BoneTransform:
     def __init__(self, bone, matrix, damping, transparency):
@@ -291,8 +606,52 @@ class SkinnedFrameData:
         self.time = time
         self.transform = transform
 
+class SkinnedBatch:
+    #All drawn bone meshes merged into one vertex and index stream in z-order.
+    #Consecutive bones that use the same textures share a single draw call,
+    #so with an atlas the whole rig is usually drawn with one call.
+    def __init__(self, key, items):
+        self.key = key
+        self.version = 1
+        self.ranges = [] #(textures, first index, index count)
+
+        vertices = []
+        uvs = []
+        weights = []
+        boneIndices = []
+        boneOwners = []
+        indices = []
+        for index, bone, textures in items:
+            mesh = bone.mesh
+            base = len(vertices) // 2
+            first = len(indices)
+            vertices.extend(mesh.vertices)
+            uvs.extend(mesh.uvs)
+            weights.extend(mesh.boneWeights)
+            boneIndices.extend(mesh.boneIndices)
+            boneOwners.extend([float(index)] * (len(mesh.vertices) // 2))
+            indices.extend([base + index for index in mesh.indices])
+
+            if self.ranges and self.ranges[-1][0] == textures:
+                textures, first, count = self.ranges[-1]
+                self.ranges[-1] = (textures, first, count + len(mesh.indices))
+            else:
+                self.ranges.append((textures, first, len(mesh.indices)))
+
+        self.vertices = skinnedmesh.makeArray(gl.GLfloat, vertices)
+        self.uvs = skinnedmesh.makeArray(gl.GLfloat, uvs)
+        self.boneWeights = skinnedmesh.makeArray(gl.GLfloat, weights)
+        self.boneIndices = skinnedmesh.makeArray(gl.GLfloat, boneIndices)
+        self.boneOwners = skinnedmesh.makeArray(gl.GLfloat, boneOwners) #Bone of the mesh of each vertex
+        self.indices = skinnedmesh.makeArray(gl.GLuint, indices)
+
+    def getIndices(self, first, count):
+        #Client side view into the index array
+        return (gl.GLuint * count).from_buffer(self.indices, first * ctypes.sizeof(gl.GLuint))
+
 class SkinnedRenderer(BaseRenderer):
     BLACK_TEXTURE = "__black"
+    BATCH_GEOMETRY = "__batch"
 
     def __init__(self):
         super(SkinnedRenderer, self).__init__()
@@ -304,14 +663,23 @@ class SkinnedRenderer(BaseRenderer):
         self.oldFrameData = {}
         self.pointResolution = 30
         self.gridResolution = 0
+        self.useAtlas = False
+        self.atlas = None
+        self.batching = False
+        self.batch = None
+        self.useBoneTexture = False
+        self.boneTexture = None
 
     def getBones(self):
         return self.bones
 
     def init(self, image, vertexShader, pixeShader, args):
-        self.shader = gpu.ShaderProgram(vertexShader.replace("MAX_BONES", str(skin.MAX_BONES)), pixeShader)
         self.pointResolution = args.get("pointResolution", self.pointResolution)
         self.gridResolution = args.get("gridResolution", self.gridResolution)
+        self.useAtlas = args.get("atlas", shader.config.rigAtlas)
+        self.batching = args.get("batch", shader.config.batchSkinnedMeshes)
+        self.useBoneTexture = args.get("boneTexture", shader.config.boneTexture) and \
+            bonedata.hasBoneDataCode(vertexShader) and gpu.isDataTextureSupported()
 
         rig = args.get("rigFile")
         if rig:
@@ -327,10 +695,27 @@ class SkinnedRenderer(BaseRenderer):
 
         for bone in self.bones.values():
             if bone.mesh:
-                bone.mesh.updateUvs(bone)
+                self.updateMeshUvs(bone)
 
         self.loadInfluenceImages()
 
+        self.shader = self.acquireShader(vertexShader, pixeShader)
+
+    def acquireShader(self, vertexShader, pixelShader):
+        vertexShader = self.createBoneDataCode(vertexShader)
+        return shader.acquireProgram(vertexShader.replace("MAX_BONES", str(skin.MAX_BONES)), pixelShader)
+
+    def createBoneDataCode(self, vertexShader):
+        if self.useBoneTexture:
+            self.boneTexture = bonedata.BoneTexture()
+        return bonedata.createShaderCode(vertexShader, self.useBoneTexture)
+
+    def uploadBoneMatrices(self, boneMatrixArray):
+        if self.boneTexture:
+            self.boneTexture.upload(self.shader, boneMatrixArray)
+        else:
+            self.shader.uniformMatrix4fArray("boneMatrices", boneMatrixArray)
+
     def updateMeshes(self, autoSubdivide=False, sizeSubdivide=0):
         transforms = self.computeBoneTransforms()
         for transform in transforms:
@@ -354,7 +739,13 @@ class SkinnedRenderer(BaseRenderer):
             if bone.mesh:
                 bone.mesh.updateVertexWeights(i, transforms, self.bones)
                 bone.mesh.sortTriangles(transforms)
-                bone.mesh.updateUvs(bone)
+                self.updateMeshUvs(bone)
+
+    def updateMeshUvs(self, bone):
+        uvRect = None
+        if self.atlas:
+            uvRect = self.atlas.getUvRect(bone.image.name)
+        bone.mesh.updateUvs(bone, uvRect)
 
     def loadJson(self, image, path):
         self.bones, data = skin.loadFromFile(path)
@@ -364,9 +755,15 @@ class SkinnedRenderer(BaseRenderer):
             if not bone.parent:
                 self.root = bone
 
-            if bone.image:
-                surface = self.loadCroppedSurface(bone, bone.image.name)
-                self.skinTextures.setTexture(bone.image.name, surface)
+        if self.useAtlas:
+            sources = lambda bone: [bone.image.name, self.getInfluenceName(bone.image.name)]
+            self.atlas = atlas.RigAtlas(path, self.bones, shader.config.rigAtlasPageSize, sources=sources)
+            for i in range(self.atlas.pageCount):
+                self.setAtlasTexture(i, False)
+        else:
+            for name, bone in self.bones.items():
+                if bone.image:
+                    self.setCroppedTexture(bone.image.name, bone, bone.image.name)
 
     def isLiveComposite(self, image):
         #TODO There must be a better way to get this...
@@ -413,7 +810,7 @@ class SkinnedRenderer(BaseRenderer):
         self.bones[bone.parent].children.append(boneName)
         self.bones[boneName] = bone
 
-        self.skinTextures.setTexture(bone.image.name, surface)
+        self.skinTextures.setTexture(bone.image.name, surface, self.getCropKey(bone, fileName))
 
     def createRootBone(self):
         root = skin.SkinningBone("root")
@@ -435,15 +832,66 @@ class SkinnedRenderer(BaseRenderer):
         crop = tuple(int(round(x)) for x in (image.x * scale, image.y * scale, image.width * scale, image.height * scale))
         return self.cropSurface(surface, crop)
 
+    def getCropKey(self, bone, name, resize=None):
+        image = bone.image
+        scaling = resize.originalWidth if resize else None
+        return (name, image.x, image.y, image.width, image.height, scaling)
+
+    def setCroppedTexture(self, sampler, bone, name, resize=None):
+        loader = lambda: self.loadCroppedSurface(bone, name, resize)
+        self.skinTextures.setTextureLoader(sampler, self.getCropKey(bone, name, resize), loader)
+
+    def getAtlasName(self, index, influence):
+        if influence:
+            return "__atlasInfluence%i" % index
+        return "__atlas%i" % index
+
+    def setAtlasTexture(self, index, influence):
+        key = (self.atlas.rigPath, "atlas", index, influence, self.atlas.pageSize)
+        loader = lambda: self.atlas.loadPage(index, influence, self.loadAtlasSurface, shader.config.rigAtlasDiskCache)
+        self.skinTextures.setTextureLoader(self.getAtlasName(index, influence), key, loader)
+
+    def hasInfluenceImage(self, bone):
+        return renpy.exports.has_image(self.getInfluenceName(bone.image.name), exact=True)
+
+    def loadAtlasSurface(self, bone, influence):
+        if influence:
+            if self.hasInfluenceImage(bone):
+                return self.loadCroppedSurface(bone, self.getInfluenceName(bone.image.name), bone.image)
+            return None
+        return self.loadCroppedSurface(bone, bone.image.name)
+
+    def getBoneTextures(self, bone):
+        textures = self.skinTextures.textures
+        if self.atlas:
+            page = self.atlas.getRegion(bone.image.name).page
+            tex = textures[self.getAtlasName(page, False)]
+            texInfluence = textures.get(self.getAtlasName(page, True))
+        else:
+            tex = textures[bone.image.name]
+            texInfluence = textures.get(self.getInfluenceName(bone.image.name))
+
+        if not texInfluence:
+            texInfluence = textures[self.BLACK_TEXTURE]
+        return tex, texInfluence
+
     def loadInfluenceImages(self):
         self.skinTextures.setTexture(self.BLACK_TEXTURE, shader.ZERO_INFLUENCE)
 
+        if self.atlas:
+            pages = set()
+            for bone in self.atlas.images.values():
+                if self.hasInfluenceImage(bone):
+                    pages.add(self.atlas.getRegion(bone.image.name).page)
+            for i in pages:
+                self.setAtlasTexture(i, True)
+            return
+
         for name, bone in self.bones.items():
             if bone.image:
                 influence = self.getInfluenceName(bone.image.name)
                 if renpy.exports.has_image(influence, exact=True):
-                    surface = self.loadCroppedSurface(bone, influence, bone.image)
-                    self.skinTextures.setTexture(influence, surface)
+                    self.setCroppedTexture(influence, bone, influence, bone.image)
 
     def getInfluenceName(self, name):
         return name.split(".")[0] + " influence"
@@ -456,13 +904,47 @@ class SkinnedRenderer(BaseRenderer):
             self.skinTextures.free()
             self.skinTextures = None
 
+        self.freeGeometries()
+        self.batch = None
+
+        if self.boneTexture:
+            self.boneTexture.free()
+            self.boneTexture = None
+
         if self.shader:
-            self.shader.free()
+            shader.releaseProgram(self.shader)
             self.shader = None
 
     def getSize(self):
         return self.size
 
+    def isTimeDependent(self):
+        for bone in self.bones.values():
+            if bone.damping > 0.0:
+                return True
+        return super(SkinnedRenderer, self).isTimeDependent()
+
+    def getPoseKey(self, bones=None):
+        if bones is None:
+            bones = self.bones
+
+        key = []
+        for name, bone in sorted(bones.items()):
+            key.append((name, tuple(bone.translation), tuple(bone.rotation), tuple(bone.scale),
+                bone.transparency, bone.visible, bone.wireFrame, bone.zOrder))
+        return tuple(key)
+
+    def getInputKey(self):
+        meshes = tuple([(bone.mesh, bone.mesh and bone.mesh.version) for name, bone in sorted(self.bones.items())])
+        return (self.getPoseKey(), meshes, self.skinTextures.getInputKey())
+
+    def getCacheKey(self):
+        #Meshes come from the rig file, which is part of the displayable tag
+        textures = self.skinTextures.getCacheKey()
+        if textures is None:
+            return None
+        return (self.getPoseKey(), textures)
+
     def getProjection(self):
         flipY = -1
         projection = utils.createPerspectiveOrtho(-1.0, 1.0, 1.0 * flipY, -1.0 * flipY, -1.0, 1.0)
@@ -473,45 +955,46 @@ class SkinnedRenderer(BaseRenderer):
         return result
 
     def render(self, context):
-        self.shader.bind()
+        self.bindShader(context)
 
-        self.setUniforms(self.shader, context.uniforms)
+        with shader.profile("uniforms"):
+            self.setUniforms(self.shader, context.uniforms)
         self.shader.uniformf("screenSize", *self.getSize())
 
         gl.glClearColor(*self.clearColor)
         gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-        gl.glDisable(gl.GL_DEPTH_TEST)
+        gpu.getState().disable(gl.GL_DEPTH_TEST)
 
-        transforms = self.computeBoneTransforms()
+        with shader.profile("bones"):
+            transforms = self.computeBoneTransforms()
+
+        self.uploadBoneMatrices(self.getBoneMatrices(context, transforms, self.oldFrameData))
 
+        with shader.profile("draw", True):
+            if self.useBatching():
+                self.renderBatch(self.getBatch(transforms))
+            else:
+                for transform in transforms:
+                    self.renderBoneTransform(transform, context)
+
+    def getBoneMatrices(self, context, transforms, oldFrameData):
         boneMatrixArray = []
         for i, transform in enumerate(transforms):
             boneMatrix = transform.matrix
             boneMatrix.p = transform.transparency #Abuse unused matrix location
 
             overwrite = transform.damping > 0.0
-            if overwrite and self.oldFrameData.get(transform.bone.name):
-                overwrite = self.dampenBoneTransform(context, transform)
+            if overwrite and oldFrameData.get(transform.bone.name):
+                overwrite = self.dampenBoneTransform(context, transform, oldFrameData)
 
             if overwrite:
-                self.oldFrameData[transform.bone.name] = SkinnedFrameData(context.shownTime, transform)
+                oldFrameData[transform.bone.name] = SkinnedFrameData(context.shownTime, transform)
 
             boneMatrixArray.extend(utils.matrixToList(boneMatrix))
-        self.shader.uniformMatrix4fArray("boneMatrices", boneMatrixArray)
-
-        for transform in transforms:
-            self.renderBoneTransform(transform, context)
-
-        for i in range(2):
-            gl.glActiveTexture(gl.GL_TEXTURE0 + i)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        return boneMatrixArray
 
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-
-        self.shader.unbind()
-
-    def dampenBoneTransform(self, context, transform):
-        data = self.oldFrameData[transform.bone.name]
+    def dampenBoneTransform(self, context, transform, oldFrameData):
+        data = oldFrameData[transform.bone.name]
         old = data.transform.matrix
 
         #Abuse unused matrix locations
@@ -538,69 +1021,149 @@ class SkinnedRenderer(BaseRenderer):
 
         return dampness <= 0.0
 
-    def renderBoneTransform(self, transform, context):
-        bone = transform.bone
-        mesh = bone.mesh
+    def useBatching(self):
+        if not self.batching:
+            return False
 
-        if not bone.image or not mesh:
+        for bone in self.bones.values():
+            if bone.wireFrame:
+                #Wireframes are drawn per bone
+                return False
+        return True
+
+    def isBoneDrawn(self, transform):
+        bone = transform.bone
+        if not bone.image or not bone.mesh:
             #No image or mesh attached
-            return
+            return False
 
         if not bone.visible or transform.transparency >= 1.0:
             #Nothing to draw
-            return
+            return False
 
-        tex = self.skinTextures.textures[bone.image.name]
-        texInfluence = self.skinTextures.textures.get(self.getInfluenceName(bone.image.name))
-        if not texInfluence:
-            texInfluence = self.skinTextures.textures[self.BLACK_TEXTURE]
+        return True
+
+    def getBatch(self, transforms):
+        #Only rebuilt when the set of drawn bones or their meshes change,
+        #transparency and movement come from the bone matrices.
+        items = []
+        key = []
+        for i, transform in enumerate(transforms):
+            if self.isBoneDrawn(transform):
+                bone = transform.bone
+                textures = self.getBoneTextures(bone)
+                items.append((i, bone, textures))
+                key.append((i, bone.name, bone.mesh, bone.mesh.version, textures))
+
+        key = tuple(key)
+        if not self.batch or self.batch.key != key:
+            self.batch = SkinnedBatch(key, items)
+        return self.batch
+
+    def getMeshAttributes(self, mesh):
+        return [
+            ("inVertex", mesh.vertices, 2),
+            ("inUv", mesh.uvs, 2),
+            ("inBoneWeights", mesh.boneWeights, 4),
+            ("inBoneIndices", mesh.boneIndices, 4),
+        ]
+
+    def bindMesh(self, key, mesh):
+        if self.useBufferObjects():
+            geometry = self.getGeometry(key, mesh, self.getMeshAttributes(mesh), mesh.indices)
+            geometry.bind(self.shader)
+            return geometry
+
+        for name, data, count in self.getMeshAttributes(mesh):
+            self.bindAttributeArray(self.shader, name, data, count)
+        return None
 
+    def unbindMesh(self, mesh, geometry):
+        if geometry:
+            geometry.unbind(self.shader)
+        else:
+            for name, data, count in self.getMeshAttributes(mesh):
+                self.unbindAttributeArray(self.shader, name)
+
+    def bindBoneTextures(self, tex, texInfluence):
         self.shader.uniformi(shader.TEX0, 0)
         tex.texture.bind(0)
 
         self.shader.uniformi(shader.TEX1, 1)
         texInfluence.texture.bind(1)
 
+    def renderBatch(self, batch):
+        if not batch.ranges:
+            return
+
+        self.shader.uniformMatrix4f(shader.PROJECTION, self.getProjection())
+        self.shader.uniformf("wireFrame", 0)
+        self.shader.uniformf("boneAlpha", 1.0) #Bone transparency is applied per vertex
+
+        geometry = self.bindMesh(self.BATCH_GEOMETRY, batch)
+
+        for textures, first, count in batch.ranges:
+            self.bindBoneTextures(*textures)
+            if geometry:
+                geometry.drawElements(gl.GL_TRIANGLES, first, count)
+            else:
+                gl.glDrawElements(gl.GL_TRIANGLES, count, gl.GL_UNSIGNED_INT, batch.getIndices(first, count))
+
+        self.unbindMesh(batch, geometry)
+
+    def renderBoneTransform(self, transform, context):
+        if not self.isBoneDrawn(transform):
+            return
+
+        bone = transform.bone
+        mesh = bone.mesh
+
+        self.bindBoneTextures(*self.getBoneTextures(bone))
+
         self.shader.uniformMatrix4f(shader.PROJECTION, self.getProjection())
 
-        self.bindAttributeArray(self.shader, "inVertex", mesh.vertices, 2)
-        self.bindAttributeArray(self.shader, "inUv", mesh.uvs, 2)
-        self.bindAttributeArray(self.shader, "inBoneWeights", mesh.boneWeights, 4)
-        self.bindAttributeArray(self.shader, "inBoneIndices", mesh.boneIndices, 4)
+        geometry = self.bindMesh(bone.name, mesh)
 
         self.shader.uniformf("wireFrame", 0)
         self.shader.uniformf("boneAlpha", max(1.0 - transform.transparency, 0))
-        gl.glDrawElements(gl.GL_TRIANGLES, len(mesh.indices), gl.GL_UNSIGNED_INT, mesh.indices)
+        self.drawMeshElements(mesh, geometry)
 
         if bone.wireFrame:
             self.shader.uniformf("wireFrame", 1)
             self.shader.uniformf("boneAlpha", 1.0)
             gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_LINE)
-            gl.glDrawElements(gl.GL_TRIANGLES, len(mesh.indices), gl.GL_UNSIGNED_INT, mesh.indices)
+            self.drawMeshElements(mesh, geometry)
             gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_FILL)
 
-        self.unbindAttributeArray(self.shader, "inVertex")
-        self.unbindAttributeArray(self.shader, "inUv")
-        self.unbindAttributeArray(self.shader, "inBoneWeights")
-        self.unbindAttributeArray(self.shader, "inBoneIndices")
+        self.unbindMesh(mesh, geometry)
+
+    def drawMeshElements(self, mesh, geometry):
+        if geometry:
+            geometry.drawElements(gl.GL_TRIANGLES)
+        else:
+            gl.glDrawElements(gl.GL_TRIANGLES, len(mesh.indices), gl.GL_UNSIGNED_INT, mesh.indices)
+
+    def computeBoneTransforms(self, bones=None):
+        #Bones can be given to pose a copy of the rig, like an instance
+        if bones is None:
+            bones = self.bones
 
-    def computeBoneTransforms(self):
         transforms = []
         stack = []
         stack.append((None, euclid.Matrix4(), 0.0, 0.0))
-        self.computeBoneTransformRecursive(self.root, transforms, stack)
+        self.computeBoneTransformRecursive(bones, bones[self.root.name], transforms, stack)
         stack.pop()
         transforms.sort(key=lambda t: t.bone.zOrder)
 
         if len(stack) != 0:
             raise RuntimeError("Unbalanced stack size: %i" % len(stack))
 
-        if len(transforms) > skin.MAX_BONES:
+        if len(transforms) > skin.MAX_BONES and not self.useBoneTexture:
             raise RuntimeError("Too many bones, maximum is %i" % skin.MAX_BONES)
 
         return transforms
 
-    def computeBoneTransformRecursive(self, bone, transforms, stack):
+    def computeBoneTransformRecursive(self, bones, bone, transforms, stack):
         parent, parentMatrix, parentDamping, parentTransparency = stack[-1]
 
         transform = euclid.Matrix4() * parentMatrix
@@ -630,6 +1193,171 @@ class SkinnedRenderer(BaseRenderer):
         stack.append((bone, transform, damping, transparency))
 
         for childName in bone.children:
-            self.computeBoneTransformRecursive(self.bones[childName], transforms, stack)
+            self.computeBoneTransformRecursive(bones, bones[childName], transforms, stack)
 
         stack.pop()
+
+class SkinnedInstance:
+    #One copy of the rig with its own pose and placement. Meshes, images and
+    #everything else that is not animated is shared with the renderer.
+    def __init__(self, bones):
+        self.bones = {}
+        for name, bone in bones.items():
+            instanceBone = skin.SkinningBone(name)
+            instanceBone.__dict__.update(bone.__dict__)
+            instanceBone.translation = bone.translation.copy()
+            instanceBone.rotation = bone.rotation.copy()
+            instanceBone.scale = bone.scale.copy()
+            self.bones[name] = instanceBone
+        self.x = 0.0
+        self.y = 0.0
+        self.scale = (1.0, 1.0)
+        self.visible = True
+        self.oldFrameData = {}
+
+    def getBones(self):
+        #Lets the instance stand in for a renderer in AnimationPlayer etc.
+        return self.bones
+
+    def getTransform(self):
+        return (self.x, self.y, self.scale[0], self.scale[1])
+
+class InstancedSkinnedRenderer(SkinnedRenderer):
+    #Draws many copies of one rig from a single mesh upload. The bone matrices
+    #of as many instances as fit into the vertex shader uniforms are uploaded
+    #together and drawn with one instanced call per texture range. Instances
+    #are drawn in list order, but with several texture ranges a later range of
+    #an earlier instance can end up on top, so use an atlas for overlapping crowds.
+
+    UNIFORM_RESERVE = 64 #Vertex uniform components left for everything else
+
+    def __init__(self):
+        super(InstancedSkinnedRenderer, self).__init__()
+        self.instances = []
+        self.canvasSize = None
+        self.hardwareInstancing = False
+        self.instancesPerDraw = 1
+
+    def init(self, image, vertexShader, pixeShader, args):
+        self.canvasSize = args.get("canvasSize")
+        super(InstancedSkinnedRenderer, self).init(image, vertexShader, pixeShader, args)
+        self.setInstanceCount(args.get("instances", 1))
+
+    def acquireShader(self, vertexShader, pixelShader):
+        boneCount = len(self.bones)
+        self.hardwareInstancing = gpu.isInstancingSupported()
+        self.instancesPerDraw = 1
+        if self.hardwareInstancing:
+            #Bones in a texture only leave the instance transforms and
+            #the visibility of each bone in the uniforms
+            components = gl.glGetIntegerv(gl.GL_MAX_VERTEX_UNIFORM_COMPONENTS)
+            boneComponents = 0 if self.useBoneTexture else boneCount * 16
+            self.instancesPerDraw = max((components - self.UNIFORM_RESERVE) // (boneComponents + boneCount + 4), 1)
+            if self.useBoneTexture:
+                #Every bone of every instance in a chunk is one texture row
+                maxRows = gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE)
+                self.instancesPerDraw = max(min(self.instancesPerDraw, maxRows // max(boneCount, 1)), 1)
+
+        maxBones = boneCount * self.instancesPerDraw
+        defines = {"MAX_BONES": maxBones, "MAX_INSTANCES": self.instancesPerDraw, "MAX_BONE_VISIBILITY": (maxBones + 3) // 4}
+        if self.hardwareInstancing:
+            defines["HARDWARE_INSTANCING"] = 1
+        return shader.acquireProgram(self.createBoneDataCode(vertexShader), pixelShader, defines)
+
+    def setInstanceCount(self, count):
+        while len(self.instances) < count:
+            self.instances.append(SkinnedInstance(self.bones))
+        del self.instances[count:]
+
+    def getInstance(self, index):
+        return self.instances[index]
+
+    def getSize(self):
+        if self.canvasSize:
+            return tuple(self.canvasSize)
+        return self.size
+
+    def isTimeDependent(self):
+        for instance in self.instances:
+            for bone in instance.bones.values():
+                if bone.damping > 0.0:
+                    return True
+        return super(InstancedSkinnedRenderer, self).isTimeDependent()
+
+    def getPoseKey(self):
+        key = []
+        for instance in self.instances:
+            key.append((instance.getTransform(), instance.visible, super(InstancedSkinnedRenderer, self).getPoseKey(instance.bones)))
+        return tuple(key)
+
+    def isBoneDrawn(self, transform):
+        if transform.bone.image and transform.bone.mesh:
+            #Decided per instance with the bone visibility, the batch has every bone
+            return True
+        return False
+
+    def getBoneVisibility(self, transforms):
+        #Whole meshes are left out like SkinnedRenderer does, the vertex
+        #shader looks up the bone that owns the mesh of each vertex.
+        return [1.0 if super(InstancedSkinnedRenderer, self).isBoneDrawn(transform) else 0.0 for transform in transforms]
+
+    def getMeshAttributes(self, mesh):
+        attributes = super(InstancedSkinnedRenderer, self).getMeshAttributes(mesh)
+        attributes.append(("inBoneOwner", mesh.boneOwners, 1))
+        return attributes
+
+    def render(self, context):
+        self.bindShader(context)
+
+        with shader.profile("uniforms"):
+            self.setUniforms(self.shader, context.uniforms)
+        self.shader.uniformf("screenSize", *self.getSize())
+
+        gl.glClearColor(*self.clearColor)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        gpu.getState().disable(gl.GL_DEPTH_TEST)
+
+        instances = [instance for instance in self.instances if instance.visible]
+        if not instances:
+            return
+
+        with shader.profile("bones"):
+            poses = [self.computeBoneTransforms(instance.bones) for instance in instances]
+
+        batch = self.getBatch(poses[0])
+        if not batch.ranges:
+            return
+
+        self.shader.uniformMatrix4f(shader.PROJECTION, self.getProjection())
+        self.shader.uniformf("wireFrame", 0)
+        self.shader.uniformf("boneAlpha", 1.0)
+        self.shader.uniformi("boneCount", len(self.bones))
+
+        with shader.profile("draw", True):
+            geometry = self.bindMesh(self.BATCH_GEOMETRY, batch)
+
+            for start in range(0, len(instances), self.instancesPerDraw):
+                chunk = range(start, min(start + self.instancesPerDraw, len(instances)))
+
+                boneMatrixArray = []
+                boneVisibility = []
+                instanceTransforms = []
+                for i in chunk:
+                    boneMatrixArray.extend(self.getBoneMatrices(context, poses[i], instances[i].oldFrameData))
+                    boneVisibility.extend(self.getBoneVisibility(poses[i]))
+                    instanceTransforms.extend(instances[i].getTransform())
+                boneVisibility.extend([0.0] * (-len(boneVisibility) % 4))
+                self.uploadBoneMatrices(boneMatrixArray)
+                self.shader.uniform4fArray("boneVisibility", boneVisibility)
+                self.shader.uniform4fArray("instanceTransforms", instanceTransforms)
+
+                for textures, first, count in batch.ranges:
+                    self.bindBoneTextures(*textures)
+                    if geometry:
+                        geometry.drawElements(gl.GL_TRIANGLES, first, count, len(chunk))
+                    elif len(chunk) > 1:
+                        gl.glDrawElementsInstanced(gl.GL_TRIANGLES, count, gl.GL_UNSIGNED_INT, batch.getIndices(first, count), len(chunk))
+                    else:
+                        gl.glDrawElements(gl.GL_TRIANGLES, count, gl.GL_UNSIGNED_INT, batch.getIndices(first, count))
+
+            self.unbindMesh(batch, geometry)
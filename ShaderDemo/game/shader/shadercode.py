@@ -136,14 +136,7 @@ void main()
 }
 """
 
-PS_BLUR_2D = """
-
-VARYING vec2 varUv;
-
-UNIFORM sampler2D tex0;
-UNIFORM float blurSize;
-UNIFORM float shownTime;
-UNIFORM vec2 imageSize;
+LIB_BLUR = """
 
 vec4 blur(sampler2D image, vec2 uv, vec2 resolution, vec2 direction) {
     vec4 color = vec4(0.0);
@@ -159,6 +152,16 @@ vec4 blur(sampler2D image, vec2 uv, vec2 resolution, vec2 direction) {
     color += texture2D(image, uv - (off3 / resolution)) * 0.010381362401148057;
     return color;
 }
+"""
+
+PS_BLUR_2D = LIB_BLUR + """
+
+VARYING vec2 varUv;
+
+UNIFORM sampler2D tex0;
+UNIFORM float blurSize;
+UNIFORM float shownTime;
+UNIFORM vec2 imageSize;
 
 void main()
 {
@@ -166,6 +169,46 @@ void main()
 }
 """
 
+#One direction of a separable blur, used by the multi-pass version of PS_BLUR_2D
+PS_BLUR_PASS_2D = LIB_BLUR + """
+
+VARYING vec2 varUv;
+
+UNIFORM sampler2D tex0;
+UNIFORM vec2 blurDirection;
+UNIFORM vec2 imageSize;
+
+void main()
+{
+    gl_FragColor = blur(tex0, varUv, imageSize.xy, blurDirection);
+}
+"""
+
+PS_COPY_2D = """
+
+VARYING vec2 varUv;
+
+UNIFORM sampler2D tex0;
+
+void main()
+{
+    gl_FragColor = texture2D(tex0, varUv);
+}
+"""
+
+PS_COPY_PREMULTIPLY = """
+
+VARYING vec2 varUv;
+
+UNIFORM sampler2D tex0;
+
+void main()
+{
+    vec4 color = texture2D(tex0, varUv);
+    gl_FragColor = vec4(color.rgb * color.a, color.a);
+}
+"""
+
 VS_3D = """
 
 ATTRIBUTE vec4 inPosition;
@@ -215,6 +258,7 @@ void main()
 }
 """
 
+#BONE_DATA_CODE is replaced with a readBone() function, see bonedata.py
 VS_SKINNED = """
 
 ATTRIBUTE vec2 inVertex;
@@ -226,10 +270,11 @@ VARYING vec2 varUv;
 VARYING float varAlpha;
 
 UNIFORM mat4 projection;
-UNIFORM mat4 boneMatrices[MAX_BONES];
 UNIFORM vec2 screenSize;
 UNIFORM float shownTime;
 
+BONE_DATA_CODE
+
 vec2 toScreen(vec2 point)
 {
     return vec2(point.x / (screenSize.x / 2.0) - 1.0, point.y / (screenSize.y / 2.0) - 1.0);
@@ -245,21 +290,106 @@ void main()
     ivec4 boneIndex = ivec4(inBoneIndices);
 
     for (int i = 0; i < 4; i++) {
-        mat4 boneMatrix = boneMatrices[boneIndex.x];
-        pos += (boneMatrix * vec4(inVertex, 0.0, 1.0) * boneWeights.x).xy;
+        vec2 axisX, axisY, offset;
+        vec4 params;
+        readBone(boneIndex.x, axisX, axisY, offset, params);
+        pos += (inVertex.x * axisX + inVertex.y * axisY + offset) * boneWeights.x;
+
+        //Apply damping
+        pos += (params.xy * boneWeights.x) * params.z;
+
+        //Apply transparency
+        transparency += params.w * boneWeights.x;
+
+        boneWeights = boneWeights.yzwx;
+        boneIndex = boneIndex.yzwx;
+    }
+    varAlpha = max(1.0 - transparency, 0.0);
+
+    gl_Position = projection * vec4(toScreen(pos.xy), 0.0, 1.0);
+}
+"""
+
+#Instances of one rig. Bone data of all instances in a draw call is in one array,
+#instanceTransforms has the offset (xy) and scale (zw) of each instance in pixels.
+#boneVisibility has four bones in each element and inBoneOwner is the bone
+#whose mesh the vertex belongs to, hidden meshes are moved out of the view.
+VS_SKINNED_INSTANCED = """
+
+#ifdef HARDWARE_INSTANCING
+    #extension GL_ARB_draw_instanced : require
+    #define INSTANCE_ID gl_InstanceIDARB
+#else
+    #define INSTANCE_ID 0
+#endif
+
+ATTRIBUTE vec2 inVertex;
+ATTRIBUTE vec2 inUv;
+ATTRIBUTE vec4 inBoneWeights;
+ATTRIBUTE vec4 inBoneIndices;
+ATTRIBUTE float inBoneOwner;
+
+VARYING vec2 varUv;
+VARYING float varAlpha;
+
+UNIFORM mat4 projection;
+UNIFORM vec4 instanceTransforms[MAX_INSTANCES];
+UNIFORM vec4 boneVisibility[MAX_BONE_VISIBILITY];
+UNIFORM int boneCount;
+UNIFORM vec2 screenSize;
+UNIFORM float shownTime;
+
+BONE_DATA_CODE
+
+vec2 toScreen(vec2 point)
+{
+    return vec2(point.x / (screenSize.x / 2.0) - 1.0, point.y / (screenSize.y / 2.0) - 1.0);
+}
+
+bool isMeshVisible()
+{
+    int owner = int(inBoneOwner) + INSTANCE_ID * boneCount;
+    vec4 visible = boneVisibility[owner / 4];
+    return dot(visible, vec4(equal(ivec4(owner - (owner / 4) * 4), ivec4(0, 1, 2, 3)))) > 0.5;
+}
+
+void main()
+{
+    if (!isMeshVisible()) {
+        //Every vertex of the triangle is outside, so nothing is drawn
+        varUv = inUv;
+        varAlpha = 0.0;
+        gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+        return;
+    }
+
+    varUv = inUv;
+
+    vec2 pos = vec2(0.0, 0.0);
+    float transparency = 0.0;
+    vec4 boneWeights = inBoneWeights;
+    ivec4 boneIndex = ivec4(inBoneIndices) + ivec4(INSTANCE_ID * boneCount);
+
+    for (int i = 0; i < 4; i++) {
+        vec2 axisX, axisY, offset;
+        vec4 params;
+        readBone(boneIndex.x, axisX, axisY, offset, params);
+        pos += (inVertex.x * axisX + inVertex.y * axisY + offset) * boneWeights.x;
 
         //Apply damping
-        vec2 boneDelta = vec2(boneMatrix[0][3], boneMatrix[1][3]);
-        pos += (boneDelta * boneWeights.x) * boneMatrix[2][3];
+        pos += (params.xy * boneWeights.x) * params.z;
 
         //Apply transparency
-        transparency += boneMatrix[3][3] * boneWeights.x;
+        transparency += params.w * boneWeights.x;
 
         boneWeights = boneWeights.yzwx;
         boneIndex = boneIndex.yzwx;
     }
     varAlpha = max(1.0 - transparency, 0.0);
 
+    vec4 instance = instanceTransforms[INSTANCE_ID];
+    pos = pos * instance.zw + instance.xy;
+
     gl_Position = projection * vec4(toScreen(pos.xy), 0.0, 1.0);
 }
 """
@@ -283,9 +413,20 @@ void main()
 """
 
 DEFERRED_MAX_LIGHTS = 8
+DEFERRED_MAX_TILED_LIGHTS = 256 #With TILED_LIGHTS, see lighting.py
 
 PS_DEFERRED = """
 
+#ifndef DEFERRED_QUALITY
+    //Everything on, quality.py compiles cheaper variants
+    #define SHADOW_SAMPLES 4
+    #define SHADOW_STEPS 10
+    #define SHADOW_TRACE_STEPS 24
+    #define FOG 1
+    #define FOG_RAIN 1
+    #define DEPTH_OF_FIELD 1
+#endif
+
 VARYING vec2 varUv;
 
 UNIFORM sampler2D tex0;
@@ -306,8 +447,25 @@ UNIFORM vec4 spriteArea;
 UNIFORM float spriteDepth;
 UNIFORM float shadowStrength;
 
-UNIFORM mat4 lights[MAX_LIGHTS];
-UNIFORM float lightCount;
+#ifdef TILED_LIGHTS
+    //Lights are binned into screen tiles on the CPU, each tile lists the lights that reach it
+    UNIFORM sampler2D lightData;
+    UNIFORM sampler2D lightTiles;
+    UNIFORM float lightDataRows;
+    UNIFORM float lightTileRows;
+    UNIFORM vec2 lightTileCount;
+#else
+    UNIFORM mat4 lights[MAX_LIGHTS];
+    UNIFORM float lightCount;
+#endif
+
+#ifdef DEPTH_PYRAMID
+    //Nearest depths of the depth map at lower resolutions, see depthpyramid.py
+    UNIFORM sampler2D depthPyramid;
+    UNIFORM vec2 depthPyramidBase;
+    UNIFORM vec2 depthPyramidSize;
+    UNIFORM float depthPyramidLevels;
+#endif
 
 const float minLightness = 0.25;
 const float sunOffsetZ = -0.5;
@@ -396,8 +554,7 @@ vec3 pointLight(vec3 pos, vec3 normal, vec3 lightPos, vec3 color, float dist) {
     delta.x = -delta.x;
 
     float strength = max(dot(normal, delta), 0.1);
-    float att = dist < 0.0 ? 1.0 : max(1.0 - (distance(posWorld, lightWorld) * 1.0), 0.0);
-    //float att = 1.0 - min( distance(posWorld, lightWorld) / dist, 1.0);
+    float att = dist < 0.0 ? 1.0 : max(1.0 - distance(posWorld, lightWorld) / max(dist, 0.0001), 0.0);
 
     return color * (strength * att);
 }
@@ -406,11 +563,61 @@ float rand(vec2 co){
     return fract(sin(dot(co.xy, vec2(12.9898, 78.233))) * 43758.5453);
 }
 
-float shadow(vec3 pos, float alpha, vec3 light, float seed) {
+#ifdef TILED_LIGHTS
+
+vec4 readDataTexel(sampler2D data, float rows, float columns, float row, float column) {
+    return texture2D(data, vec2((column + 0.5) / columns, (row + 0.5) / rows));
+}
+
+vec3 indexedLight(vec3 pos, vec3 normal, float index) {
+    if (index < 0.0) {
+        return vec3(0.0);
+    }
+    vec4 posAndDist = readDataTexel(lightData, lightDataRows, 2.0, index, 0.0);
+    vec4 color = readDataTexel(lightData, lightDataRows, 2.0, index, 1.0);
+    return pointLight(pos, normal, posAndDist.xyz, color.rgb, posAndDist.w);
+}
+
+vec3 sumLights(vec3 pos, vec3 normal) {
+    vec2 tile = min(floor(varUv * lightTileCount), lightTileCount - 1.0);
+    float row = tile.y * lightTileCount.x + tile.x;
+
+    vec3 light = vec3(0.0);
+    for (int i = 0; i < TILE_TEXELS; ++i) {
+        //Four light indices per texel, unused ones are negative
+        vec4 indices = readDataTexel(lightTiles, lightTileRows, float(TILE_TEXELS), row, float(i));
+        if (indices.x < 0.0) {
+            break;
+        }
+        light += indexedLight(pos, normal, indices.x);
+        light += indexedLight(pos, normal, indices.y);
+        light += indexedLight(pos, normal, indices.z);
+        light += indexedLight(pos, normal, indices.w);
+    }
+    return light;
+}
+
+#else
+
+vec3 sumLights(vec3 pos, vec3 normal) {
+    vec3 light = vec3(0.0);
+    for (int i=0; i < lightCount; ++i) {
+        mat4 lightData = lights[i];
+        vec3 lPos = vec3(lightData[0][0], lightData[1][0], lightData[2][0]);
+        vec3 lColor = vec3(lightData[0][1], lightData[1][1], lightData[2][1]);
+        float dist = lightData[0][2];
+        light += pointLight(pos, normal, lPos, lColor, dist);
+    }
+    return light;
+}
+
+#endif
+
+float shadowMarch(vec3 pos, float alpha, vec3 light, float seed) {
     //light.z += sunOffsetZ * 0.1;
     light.z -= 0.1;
 
-    const int steps = 10;
+    const int steps = SHADOW_STEPS;
     float stepJitter = rand(pos.xy + vec2(seed, seed * seed)) * 1.0;
 
     for (int i=0; i < steps; ++i) {
@@ -432,13 +639,93 @@ float shadow(vec3 pos, float alpha, vec3 light, float seed) {
     return 1.0;
 }
 
+#ifdef DEPTH_PYRAMID
+
+const int pyramidSteps = SHADOW_TRACE_STEPS;
+
+float pyramidDepth(vec2 cell, float level) {
+    if (level == 0.0) {
+        return pixelPos((cell + 0.5) / depthPyramidBase).z;
+    }
+
+    float cellSize = exp2(level);
+    cell = clamp(cell, vec2(0.0), ceil(depthPyramidBase / cellSize) - 1.0);
+    float offset = ceil(depthPyramidBase.x * (1.0 - exp2(1.0 - level))) + level - 1.0;
+    vec4 texel = texture2D(depthPyramid, (vec2(offset, 0.0) + cell + 0.5) / depthPyramidSize);
+    float depth = (texel.r + texel.g + texel.b) / 3.0;
+
+    //The composited sprite can be nearer than the depth map
+    vec2 cellStart = cell * cellSize / depthPyramidBase;
+    vec2 cellEnd = cellStart + cellSize / depthPyramidBase;
+    if (spriteDepth > 0.0 && cellEnd.x > spriteArea.x && cellStart.x < spriteArea.y && cellEnd.y > spriteArea.z && cellStart.y < spriteArea.w) {
+        depth = min(depth, spriteDepth);
+    }
+    return depth;
+}
+
+float shadowTrace(vec3 pos, float alpha, vec3 light, float seed) {
+    light.z -= 0.1;
+
+    //Ray in depth map pixels, with the same jittered length as shadowMarch()
+    float rayJitter = rand(pos.xy + vec2(seed, seed * seed));
+    vec3 start = vec3(pos.xy * depthPyramidBase, pos.z);
+    vec3 dir = (vec3(light.xy * depthPyramidBase, light.z) - start) * rayJitter;
+    vec2 safeDir = mix(vec2(0.0001), dir.xy, step(0.0001, abs(dir.xy)));
+    float nudge = 0.01 / max(length(dir.xy), 0.01);
+
+    float level = 1.0;
+    float t = 0.0;
+    for (int i=0; i < pyramidSteps; ++i) {
+        if (t >= 1.0) {
+            break;
+        }
+
+        vec3 p = start + dir * t;
+        float cellSize = exp2(level);
+        vec2 cell = floor(p.xy / cellSize);
+        vec2 exits = ((cell + step(0.0, safeDir)) * cellSize - start.xy) / safeDir;
+        float tExit = min(min(exits.x, exits.y), 1.0);
+
+        //Deepest point of the ray inside this cell against the nearest surface
+        float rayZ = max(p.z, start.z + dir.z * tExit);
+        float depth = pyramidDepth(cell, level) * 1.05;
+
+        if (level == 0.0 && rayZ - rand(p.xy) * 0.01 > depth) {
+            return 1.0 - max(alpha, 0.1) * shadowStrength;
+        }
+
+        if (level == 0.0 || rayZ <= depth) {
+            //Nothing in the cell can block the light, skip it and try a larger one
+            t = tExit + nudge;
+            level = min(level + 1.0, depthPyramidLevels);
+        }
+        else {
+            level -= 1.0;
+        }
+    }
+    return 1.0;
+}
+
+#endif
+
+float shadow(vec3 pos, float alpha, vec3 light, float seed) {
+#ifdef DEPTH_PYRAMID
+    if (depthPyramidLevels > 0.0) {
+        return shadowTrace(pos, alpha, light, seed);
+    }
+#endif
+    return shadowMarch(pos, alpha, light, seed);
+}
+
 float fog(vec3 pos, float alpha, float start, float end) {
     float depth = pos.z - (alpha * 0.1); //Window rain etc. better
     float f = 1.0 - clamp((end - depth) / (end - start), 0.0, 1.0);
 
+#if FOG_RAIN
     if (fogRainEnabled != 0.0) {
         return f * (rand(vec2(pos.x * depth, shownTime)) * 0.2 + 1.0);
     }
+#endif
     return f;
 }
 
@@ -465,7 +752,11 @@ void main()
 {
     vec4 data = pixelPos(varUv);
     vec3 normal = pixelNormal(data.xyz);
+#if DEPTH_OF_FIELD
     vec4 color = depthOfField(data);
+#else
+    vec4 color = texture2D(tex0, data.xy);
+#endif
     vec3 pos = data.xyz;
     float alpha = data.w;
 
@@ -473,15 +764,9 @@ void main()
         color.rgba = zComposite(pos, color, varUv).rgba;
     }
 
-    vec3 light = ambientLight;
-    for (int i=0; i < lightCount; ++i) {
-        mat4 lightData = lights[i];
-        vec3 lPos = vec3(lightData[0][0], lightData[1][0], lightData[2][0]);
-        vec3 lColor = vec3(lightData[0][1], lightData[1][1], lightData[2][1]);
-        float dist = lightData[0][2];
-        light.rgb += pointLight(pos, normal, lPos, lColor, dist);
-    }
+    vec3 light = ambientLight + sumLights(pos, normal);
 
+#if SHADOW_SAMPLES > 0
     if (shadowStrength > 0.0) {
         vec3 mouse = pixelPos(mousePos).xyz;
         float w = 2.0 / imageSize.x;
@@ -489,17 +774,22 @@ void main()
 
         float strength = 1.0;
         strength *= shadow(pos, alpha, mouse, 0);
+    #if SHADOW_SAMPLES > 1
         strength *= shadow(pos, alpha, mouse + vec3(w, 0.0, 0.0), 1);
         strength *= shadow(pos, alpha, mouse + vec3(0.0, h, 0.0), 2);
         strength *= shadow(pos, alpha, mouse + vec3(w, h, 0.0), 3);
+    #endif
         color.rgb *= strength;
     }
+#endif
 
     vec4 result = color * vec4(light.rgb, 1.0);
 
+#if FOG
     if (abs(fogRange.x - fogRange.y) > 0.0) {
         result.rgb = mix(result.rgb, light * fogColor, fog(pos, alpha, fogRange.x, fogRange.y));
     }
+#endif
 
     /*
     if (pos.z >= 0.5 && pos.z <= 0.51) {
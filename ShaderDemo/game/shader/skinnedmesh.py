@@ -11,9 +11,10 @@ def roundPoint(x, y):
     return (int(round(x)), int(round(y)))
 
 class SkinnedMesh:
-    jsonIgnore = ["uvs"]
+    jsonIgnore = ["uvs", "version"]
 
     def __init__(self, vertices, indices, boneWeights=None, boneIndices=None):
+        self.version = 0 #Incremented every time the mesh data changes
         self.setGeometry(vertices, indices)
         self.boneWeights = boneWeights
         self.boneIndices = boneIndices
@@ -24,6 +25,7 @@ class SkinnedMesh:
         self.uvs = None
         self.boneWeights = None
         self.boneIndices = None
+        self.version += 1
 
     def getTriangleIndices(self):
         triangles = []
@@ -225,21 +227,26 @@ class SkinnedMesh:
             indices.extend(tri[1:])
 
         self.indices = makeArray(gl.GLuint, indices)
+        self.version += 1
 
-    def updateUvs(self, bone):
+    def updateUvs(self, bone, uvRect=None):
+        #Optional uvRect (x, y, width, height) maps the uvs into a part of an atlas texture
         w = bone.image.width
         h = bone.image.height
+        uvX, uvY, uvWidth, uvHeight = uvRect or (0.0, 0.0, 1.0, 1.0)
         uvs = []
         for i in range(0, len(self.vertices), 2):
             xUv = (self.vertices[i] - bone.pos[0]) / float(w)
             yUv = (self.vertices[i + 1] - bone.pos[1]) / float(h)
-            uvs.extend([xUv, yUv])
+            uvs.extend([uvX + xUv * uvWidth, uvY + yUv * uvHeight])
         self.uvs = makeArray(gl.GLfloat, uvs)
+        self.version += 1
 
     def moveVertices(self, offset):
         for i in range(0, len(self.vertices), 2):
             self.vertices[i] = self.vertices[i] + offset[0]
             self.vertices[i + 1] = self.vertices[i + 1] + offset[1]
+        self.version += 1
 
     def updateVertexWeights(self, index, transforms, bones):
         mapping = {}
@@ -270,6 +277,7 @@ class SkinnedMesh:
 
         self.boneWeights = makeArray(gl.GLfloat, weights)
         self.boneIndices = makeArray(gl.GLfloat, indices)
+        self.version += 1
 
 def findBoneImageBone(bone, bones):
     for parent in [bone] + bone.getParents(bones):
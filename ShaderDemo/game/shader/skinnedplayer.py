@@ -1,4 +1,5 @@
 
+import shader
 import skin
 import skinnedanimation
 import euclid
@@ -149,19 +150,20 @@ class AnimationPlayer:
             self.debugY += utils.drawText(self.context.overlayCanvas, text, pos, color)[1]
 
     def play(self, infos, rest=True):
-        for info in infos:
-            if not info.name in self.data.tracks:
-                self.startAnimation(info)
+        with shader.profile("animation"):
+            for info in infos:
+                if not info.name in self.data.tracks:
+                    self.startAnimation(info)
 
-        self.updateAnimations()
+            self.updateAnimations()
 
-        names = [i.name for i in infos]
-        for name in self.data.tracks.copy():
-            if not name in names:
-                self.stopAnimation(name)
+            names = [i.name for i in infos]
+            for name in self.data.tracks.copy():
+                if not name in names:
+                    self.stopAnimation(name)
 
-        if rest:
-            self.restBones()
+            if rest:
+                self.restBones()
 
     def restBones(self):
         animated = self.getAnimatedBoneNames()
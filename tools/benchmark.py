@@ -0,0 +1,203 @@
+
+"""
+    Renders shader displayables offscreen without Ren'Py and reports frames
+    per second and per-phase timings. Uses the stand-ins in headless_renpy.py
+    and a software OpenGL context, either OSMesa or a hidden window that can
+    be forced to llvmpipe with LIBGL_ALWAYS_SOFTWARE=1.
+
+    Requires pygame and PyOpenGL (with OSMesa for the default platform).
+
+    Command line examples (current working directory at the base of this project):
+
+        python tools/benchmark.py --rig doll --anim "doll flail.anim" --frames 300
+        python tools/benchmark.py --rig doll --anim "doll kneel.anim" --instances 10
+        python tools/benchmark.py --mode 2d --image amy --shader blur --csv blur.csv
+        python tools/benchmark.py --rig doll --gl-json doll.json --gl-budget drawCalls=1 --gl-budget calls=200
+
+    Frames are rendered with a fixed time step so runs are repeatable. The
+    numbers are only comparable between runs on the same machine and driver.
+    GL call counts from --gl-json are deterministic and can be compared
+    anywhere. The script exits with 1 if a --gl-budget is exceeded.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import headless_renpy
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ShaderDemo", "game")
+
+PHASES = ["frame", "update", "animation", "render", "uniforms", "bones", "draw", "readback"]
+
+parser = argparse.ArgumentParser(description="Offscreen shader benchmark")
+parser.add_argument("--mode", choices=["rig", "2d"], default="rig")
+parser.add_argument("--rig", default="doll", help="Rig name, loads rig/<name>.rig")
+parser.add_argument("--anim", action="append", default=[], help="Animation to play, can be given many times")
+parser.add_argument("--instances", type=int, default=0, help="Draw this many instanced copies of the rig")
+parser.add_argument("--image", default="amy", help="Image for the 2d mode")
+parser.add_argument("--shader", choices=["blur", "wind"], default="blur", help="Pixel shader for the 2d mode")
+parser.add_argument("--frames", type=int, default=300)
+parser.add_argument("--warmup", type=int, default=30, help="Frames rendered before timing starts")
+parser.add_argument("--fps", type=float, default=60.0, help="Simulated frame rate for the time step")
+parser.add_argument("--platform", choices=["osmesa", "window"], default="osmesa")
+parser.add_argument("--size", type=int, nargs=2, default=(1280, 720), help="Size of the OpenGL context")
+parser.add_argument("--csv", help="Write per-phase percentiles into this file")
+parser.add_argument("--gl-json", help="Record OpenGL calls and write per-frame counts into this file")
+parser.add_argument("--gl-budget", action="append", default=[], metavar="COUNTER=N",
+    help="Most a single frame may use of a GL counter, like drawCalls=1. Can be given many times")
+parser.add_argument("--verbose", action="store_true", help="Print shader log messages")
+options = parser.parse_args()
+
+headless_renpy.install(GAME_DIR, options.platform, options.verbose)
+glContext = headless_renpy.createContext(options.size[0], options.size[1])
+
+import renpy
+import shader
+from OpenGL import GL as gl
+
+def createRenderer():
+    if options.mode == "rig":
+        rigFile = shader.utils.findFile(options.rig + ".rig")
+        if not rigFile:
+            raise RuntimeError("No .rig-file found for '%s'" % options.rig)
+        image = renpy.exports.displayable(options.rig)
+        if options.instances:
+            renderer = shader.InstancedSkinnedRenderer()
+            renderer.init(image, shader.VS_SKINNED_INSTANCED, shader.PS_SKINNED,
+                {"rigFile": rigFile, "instances": options.instances, "canvasSize": options.size})
+            placeInstances(renderer)
+        else:
+            renderer = shader.SkinnedRenderer()
+            renderer.init(image, shader.VS_SKINNED, shader.PS_SKINNED, {"rigFile": rigFile})
+    else:
+        pixelShader = {"blur": shader.PS_BLUR_2D, "wind": shader.PS_WIND_2D}[options.shader]
+        renderer = shader.Renderer2D()
+        renderer.init(renpy.exports.displayable(options.image), shader.VS_2D, pixelShader)
+    return renderer
+
+def placeInstances(renderer):
+    #A row of half size characters
+    width, height = renderer.getSize()
+    rigWidth, rigHeight = renderer.size
+    step = (width - rigWidth * 0.5) / max(len(renderer.instances) - 1, 1)
+    for i, instance in enumerate(renderer.instances):
+        instance.x = i * step
+        instance.y = height - rigHeight * 0.5
+        instance.scale = (0.5, 0.5)
+
+def update(context):
+    if options.mode == "rig" and options.anim:
+        tracks = [shader.TrackInfo(name, cyclic=True) for name in options.anim]
+        if options.instances:
+            for i, instance in enumerate(context.renderer.instances):
+                #Offset the time so the instances are in different poses
+                instanceContext = context.withRenderer(instance)
+                instanceContext.shownTime += i * 0.1
+                shader.AnimationPlayer(instanceContext, "%s%i" % (options.rig, i)).play(tracks)
+        else:
+            shader.AnimationPlayer(context, options.rig).play(tracks)
+
+def renderFrames(controller, surfacePool, store, frames, startFrame):
+    width, height = controller.getSize()
+    for i in range(startFrame, startFrame + frames):
+        shownTime = i / options.fps
+        uniforms = {"shownTime": shownTime, "animationTime": shownTime, "mousePos": (0.0, 0.0)}
+        context = shader.RenderContext(controller.renderer, width, height, shownTime,
+            shownTime, shownTime, uniforms, (0, 0), [], store)
+
+        with shader.profile("update"):
+            update(context)
+
+        with shader.profile("frame"):
+            with shader.profile("render", True):
+                controller.renderImage(context)
+            with shader.profile("readback"):
+                controller.copyRenderBuffer(surfacePool)
+            controller.releaseFrameBuffer()
+
+        shader.getProfiler().endFrame()
+        shader.endGLFrame()
+
+def parseBudgets(values):
+    budgets = {}
+    for value in values:
+        name, count = value.split("=", 1)
+        budgets[name.strip()] = int(count)
+    return budgets
+
+def formatTimes(times):
+    if not times:
+        return "%26s" % "-"
+    return "%8.3f %8.3f %8.3f" % tuple(times)
+
+def printSummary(frames, seconds):
+    print("%i frames in %.2f s, %.1f fps" % (frames, seconds, frames / seconds))
+    print("")
+    print("%-10s %7s %26s %26s" % ("phase", "samples", "cpu p50/p90/p99 ms", "gpu p50/p90/p99 ms"))
+
+    summary = shader.getProfiler().getSummary()
+    summary.sort(key=lambda entry: PHASES.index(entry[0]) if entry[0] in PHASES else len(PHASES))
+    for name, count, cpu, gpu in summary:
+        print("%-10s %7i %s %s" % (name, count, formatTimes(cpu), formatTimes(gpu)))
+
+def main():
+    print("Renderer: %s, %s" % (gl.glGetString(gl.GL_RENDERER), gl.glGetString(gl.GL_VERSION)))
+
+    shader.config.profile = True
+    shader.getProfiler().historySize = max(options.frames, 1)
+    shader.getProfiler().reset()
+
+    controller = shader.RenderController()
+    controller.init(createRenderer())
+    surfacePool = shader.controller.SurfacePool(shader.config.surfacePoolSize)
+    store = {}
+
+    renderFrames(controller, surfacePool, store, options.warmup, 0)
+    gl.glFinish()
+    shader.getProfiler().reset()
+
+    recorder = None
+    budgets = parseBudgets(options.gl_budget)
+    if options.gl_json or budgets:
+        recorder = shader.startGLRecording()
+
+    start = time.time()
+    renderFrames(controller, surfacePool, store, options.frames, options.warmup)
+    gl.glFinish()
+    seconds = time.time() - start
+
+    if recorder:
+        shader.stopGLRecording()
+
+    #Pick up the last GPU timer results
+    shader.getProfiler().endFrame()
+
+    printSummary(options.frames, seconds)
+    if options.csv:
+        shader.exportProfile(options.csv)
+        print("Wrote %s" % options.csv)
+
+    result = 0
+    if recorder:
+        perFrame = recorder.getSummary()["perFrame"]
+        print("")
+        print("%-16s %10s %10s" % ("gl counter", "mean", "max"))
+        for name in shader.gpu.glrecorder.COUNTERS:
+            print("%-16s %10.1f %10i" % (name, perFrame[name]["mean"], perFrame[name]["max"]))
+
+        if options.gl_json:
+            recorder.exportJson(options.gl_json)
+            print("Wrote %s" % options.gl_json)
+
+        for failure in recorder.checkBudgets(budgets):
+            print("Over budget: %s" % failure)
+            result = 1
+
+    controller.free()
+    shader.trimFrameBuffers()
+    return result
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+
+"""
+    Minimal stand-ins for the parts of Ren'Py the shader package uses, so
+    the package can be imported and run outside a game. Only meant for
+    benchmarks and tests, nothing is drawn on screen.
+
+    Call install() before importing the shader package or PyOpenGL and
+    createContext() before creating any renderers.
+"""
+
+import os
+import sys
+import types
+
+IMAGES = ["png", "jpg"]
+
+gameDir = None
+glPlatform = None
+
+def resolveImage(name):
+    #Ren'Py style lookup, either a file relative to the game directory or an automatic image name
+    candidates = [name]
+    for extension in IMAGES:
+        candidates.append(name + "." + extension)
+        candidates.append(os.path.join("images", name + "." + extension))
+
+    for candidate in candidates:
+        path = os.path.join(gameDir, candidate)
+        if os.path.isfile(path):
+            return path
+    return None
+
+class Image(object):
+    def __init__(self, name):
+        self.name = name
+        #None for images the harness can't resolve, like LiveComposites. Fine for rigs.
+        self.filename = resolveImage(name)
+
+    def visit(self):
+        return []
+
+class Canvas(object):
+    def rect(self, *args):
+        pass
+
+    def line(self, *args):
+        pass
+
+    def lines(self, *args):
+        pass
+
+    def circle(self, *args):
+        pass
+
+class Render(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.children = []
+
+    def blit(self, source, pos):
+        self.children.append((source, pos))
+
+    def canvas(self):
+        return Canvas()
+
+    def zoom(self, xzoom, yzoom):
+        pass
+
+    def get_size(self):
+        return self.width, self.height
+
+class Text(object):
+    def __init__(self, text, **properties):
+        self.text = text
+
+class Log(object):
+    def __init__(self, verbose):
+        self.verbose = verbose
+        self.lines = []
+
+    def write(self, message):
+        self.lines.append(message)
+        if self.verbose:
+            print(message)
+
+def createModule(name, **attributes):
+    module = types.ModuleType(name)
+    for key, value in attributes.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+    return module
+
+def install(directory, platform="osmesa", verbose=False):
+    global gameDir, glPlatform
+    gameDir = os.path.abspath(directory)
+    glPlatform = platform
+    if platform == "osmesa":
+        #Must be set before PyOpenGL is imported
+        os.environ["PYOPENGL_PLATFORM"] = "osmesa"
+
+    import pygame
+    sys.modules["pygame_sdl2"] = pygame
+    sys.path.insert(0, gameDir)
+
+    def loadSurface(image):
+        if not image.filename:
+            raise IOError("Image not found: %s" % image.name)
+        loaded = pygame.image.load(image.filename)
+        surface = pygame.Surface(loaded.get_size(), pygame.SRCALPHA, 32)
+        surface.blit(loaded, (0, 0))
+        return surface
+
+    def createSurface(size, alpha):
+        return pygame.Surface(size, pygame.SRCALPHA if alpha else 0, 32)
+
+    def loadImage(f, name):
+        loaded = pygame.image.load(f, name)
+        surface = createSurface(loaded.get_size(), True)
+        surface.blit(loaded, (0, 0))
+        return surface
+
+    def loadTexture(surface):
+        raise AttributeError("Texture output is not available headless")
+
+    def listFiles():
+        results = []
+        for root, dirs, files in os.walk(gameDir):
+            for f in files:
+                results.append(os.path.relpath(os.path.join(root, f), gameDir).replace("\\", "/"))
+        results.sort()
+        return results
+
+    def openFile(path):
+        if not os.path.isabs(path):
+            path = os.path.join(gameDir, path)
+        return open(path, "rb")
+
+    def hasImage(name, exact=False):
+        return resolveImage(name) is not None
+
+    def render(displayable, width, height, st, at):
+        return Render(width, height)
+
+    config = createModule("renpy.config", gamedir=gameDir, savedir=os.path.join(gameDir, "saves"),
+        gl_enable=True, developer=True)
+    im = createModule("renpy.display.im", load_surface=loadSurface)
+    pgrender = createModule("renpy.display.pgrender", surface=createSurface, load_image=loadImage)
+    renderModule = createModule("renpy.display.render", Render=Render, render=render,
+        mutated_surface=lambda surface: None)
+    log = Log(verbose)
+    draw = createModule("renpy.display.draw", info={"renderer": "gl"}, load_texture=loadTexture)
+    interface = createModule("renpy.display.interface", set_mode=lambda *args: None)
+    display = createModule("renpy.display", im=im, pgrender=pgrender, render=renderModule,
+        log=log, draw=draw, interface=interface)
+    exports = createModule("renpy.exports", file=openFile, list_files=listFiles, has_image=hasImage,
+        displayable=Image, render=render, Render=Render, showing=lambda *args, **kwargs: False)
+    textModule = createModule("renpy.text.text", Text=Text)
+    text = createModule("renpy.text", text=textModule)
+    createModule("renpy", config=config, display=display, exports=exports, text=text,
+        Render=Render, render=render, showing=exports.showing, get_renderer_info=lambda: draw.info)
+
+def createContext(width, height):
+    #Offscreen OSMesa context or a window (use LIBGL_ALWAYS_SOFTWARE=1 for llvmpipe)
+    if glPlatform == "osmesa":
+        from OpenGL import GL as gl
+        from OpenGL import osmesa, arrays
+        context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not context:
+            raise RuntimeError("Can't create OSMesa context")
+        buffer = arrays.GLubyteArray.zeros((height, width, 4))
+        if not osmesa.OSMesaMakeCurrent(context, buffer, gl.GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError("Can't make OSMesa context current")
+        return context, buffer
+
+    import pygame
+    pygame.display.init()
+    return pygame.display.set_mode((width, height), pygame.OPENGL | pygame.DOUBLEBUF), None